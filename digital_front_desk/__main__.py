@@ -1,42 +1,21 @@
+import os
 import uvicorn
-from .api import app
-import asyncio
-from .context_manager import context_manager
-import signal
-import sys
-
-async def cleanup_task():
-    """Periodic task to clean up old contexts"""
-    while True:
-        await asyncio.sleep(3600)  # Run every hour
-        context_manager.cleanup_old_contexts()
-
-def signal_handler(sig, frame):
-    print("\nShutting down gracefully...")
-    sys.exit(0)
 
 def main():
-    # Set up signal handlers
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-    
-    # Create new event loop
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    
-    # Start the cleanup task
-    loop.create_task(cleanup_task())
+    # Each worker process keeps its own in-memory users, contexts and queue,
+    # so default to a single worker; set WEB_CONCURRENCY to run more
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
     
     # Run the application
-    config = uvicorn.Config(
-        app=app,
+    uvicorn.run(
+        "digital_front_desk.api:app",
         host="0.0.0.0",
         port=8000,
-        log_level="info",
-        loop=loop
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+        log_level="info"
     )
-    server = uvicorn.Server(config)
-    loop.run_until_complete(server.serve())
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -5,21 +5,97 @@ from .queue_manager import queue_manager
 from .context_manager import context_manager
 from .pdf_knowledge_base import pdf_knowledge_base
 import openai
+import httpx
+import tiktoken
+import logging
+from cachetools import LRUCache
+import asyncio
 import time
+import re
 import json
-from typing import Tuple, List
+import orjson
+from typing import AsyncIterator, Optional, Tuple, List
 import os
 from dotenv import load_dotenv
 from opentelemetry import trace
 from opentelemetry.trace import Status, StatusCode
-from datetime import datetime
+from datetime import datetime, timezone
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Token budget for the conversation history sent before the new message
+HISTORY_TOKEN_BUDGET = 1500
+# Rough characters per token, used when the tiktoken encoding cannot be loaded
+CHARS_PER_TOKEN = 4
+
+class _JSONStringFieldStream:
+    """
+    Incrementally extracts one string field from a JSON object that arrives
+    in fragments, returning the decoded text as soon as it is available.
+    """
+
+    def __init__(self, field: str):
+        self._key = re.compile(r'"%s"\s*:\s*"' % re.escape(field))
+        self._buffer = ""
+        self._pos = None  # Index of the next unread character of the value
+        self._done = False
+
+    def feed(self, fragment: str) -> str:
+        self._buffer += fragment
+        if self._done:
+            return ""
+        
+        buffer = self._buffer
+        if self._pos is None:
+            match = self._key.search(buffer)
+            if not match:
+                return ""
+            self._pos = match.end()
+        
+        parts = []
+        i = self._pos
+        while i < len(buffer):
+            char = buffer[i]
+            if char == '"':
+                self._done = True
+                break
+            if char == "\\":
+                # Wait for the whole escape sequence (including surrogate pairs)
+                length = 2
+                if buffer[i + 1:i + 2] == "u":
+                    length = 6
+                    if buffer[i + 2:i + 4].lower() in ("d8", "d9", "da", "db"):
+                        length = 12
+                if i + length > len(buffer):
+                    break
+                parts.append(json.loads(f'"{buffer[i:i + length]}"'))
+                i += length
+                continue
+            end = i
+            while end < len(buffer) and buffer[end] not in '"\\':
+                end += 1
+            parts.append(buffer[i:end])
+            i = end
+        
+        self._pos = i
+        return "".join(parts)
+
 class AgentProcessor:
     def __init__(self):
-        self.client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        # Shared connection pool so concurrent requests reuse keep-alive connections
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+        )
+        self.client = openai.AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            http_client=self.http_client
+        )
         self.model = "gpt-4o-mini"  
+        self._encoding = None  # Loaded at startup by load_encoding, as tiktoken may fetch it
+        # Token counts by turn content, kept beside the history so stored turns stay clean
+        self._token_counts: LRUCache = LRUCache(maxsize=4096)
         
         # Enhanced system prompt with ESI triage algorithm
         self.system_prompt = """You are a medical front desk AI assistant. Your role is to:
@@ -67,179 +143,318 @@ When gathering information, ask specific questions to:
 
 Always err on the side of caution when assessing medical situations."""
 
+        # The static prompt is always sent verbatim as the first message so that
+        # OpenAI's automatic prompt caching can reuse it across requests
+        self._system_message = {"role": "system", "content": self.system_prompt}
+
+        # The structured-output schema is invariant, so build it once and pass it by reference
+        self._param_schema = {
+            "type": "object",
+            "properties": {
+                "content": {
+                    "type": "string",
+                    "description": "The response message to the user"
+                },
+                "triage_score": {
+                    "type": "number",
+                    "description": "Urgency score from 0-1"
+                },
+                "esi_level": {
+                    "type": "integer",
+                    "enum": [1, 2, 3, 4, 5],
+                    "description": "ESI triage level (1=most urgent, 5=least urgent)"
+                },
+                "confidence": {
+                    "type": "number",
+                    "description": "Confidence in the assessment from 0-1"
+                },
+                "suggested_actions": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "List of suggested actions"
+                },
+                "expected_resources": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "List of expected resources needed (lab_test, imaging, iv_fluids, medication, specialist_consult, procedure, none)"
+                },
+                "vital_signs_concerns": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "List of vital sign concerns if any (empty if none)"
+                }
+            },
+            # Strict mode requires every property to be listed and no extras
+            "required": [
+                "content", "triage_score", "esi_level", "confidence",
+                "suggested_actions", "expected_resources", "vital_signs_concerns"
+            ],
+            "additionalProperties": False
+        }
+        self._response_format = {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "process_medical_inquiry",
+                "description": "Process a medical inquiry and provide structured response with ESI triage",
+                "strict": True,
+                "schema": self._param_schema
+            }
+        }
+
+    def _start_guidelines_retrieval(self, message: str) -> Optional[asyncio.Task]:
+        """Start retrieving ESI guidelines for the message so it overlaps other work"""
+        if not pdf_knowledge_base.loaded:
+            return None
+        return asyncio.ensure_future(pdf_knowledge_base.get_context_for_symptoms(message))
+
+    async def _load_recent_history(self, channel_input: ChannelInput) -> Tuple[dict, List[dict]]:
+        """Return the pending user turn and the recent history it is sent with"""
+        # Get conversation context
+        context = await context_manager.get_context(channel_input.user_id)
+        
+        # Walk back from the newest turn until the token budget is spent
+        history = []
+        if context:
+            remaining = HISTORY_TOKEN_BUDGET
+            for turn in reversed(context.conversation_history):
+                remaining -= self._turn_tokens(turn)
+                if remaining < 0:
+                    break
+                history.append(turn)
+            history.reverse()
+        
+        # One clock read per exchange; the assistant turn reuses this timestamp
+        user_turn = {
+            "role": "user",
+            "content": channel_input.message,
+            "timestamp": datetime.now(timezone.utc)
+        }
+        self._turn_tokens(user_turn)
+        
+        return user_turn, [*history, user_turn]
+
+    async def load_encoding(self) -> None:
+        """Load the model's tokenizer off the event loop, falling back to a length estimate"""
+        try:
+            self._encoding = await asyncio.to_thread(tiktoken.encoding_for_model, self.model)
+        except Exception as e:
+            logger.warning("tiktoken encoding unavailable, estimating tokens from length: %s", e)
+
+    def _turn_tokens(self, turn: dict) -> int:
+        """Return the token count of a turn, cached by its content"""
+        content = turn["content"]
+        tokens = self._token_counts.get(content)
+        if tokens is None:
+            if self._encoding is None:
+                tokens = len(content) // CHARS_PER_TOKEN + 1
+            else:
+                tokens = len(self._encoding.encode(content))
+            self._token_counts[content] = tokens
+        return tokens
+
+    def _build_messages(self, recent_history: List[dict], esi_guidelines_context: str) -> list:
+        """Build the AI message list from the recent history and ESI guidelines"""
+        # Invariant content comes first and per-request content last to keep
+        # the cacheable prefix stable.
+        messages = [self._system_message]
+        
+        # Add relevant ESI guidelines if available
+        if esi_guidelines_context:
+            messages.append({
+                "role": "system", 
+                "content": f"Reference the following specific ESI guidelines when assessing this patient:\n\n{esi_guidelines_context}"
+            })
+        
+        # Add relevant conversation history
+        for msg in recent_history:
+            messages.append({
+                "role": msg["role"],
+                "content": msg["content"]
+            })
+        
+        return messages
+
+    async def _complete_exchange(
+        self,
+        channel_input: ChannelInput,
+        user_turn: dict,
+        response: dict
+    ) -> Tuple[AgentResponse, TriageResult]:
+        """Record the exchange, triage the AI response and queue it if needed"""
+        # Create agent response
+        agent_response = AgentResponse(
+            response=response["content"],
+            triage_score=response["triage_score"],
+            confidence_score=response["confidence"],
+            suggested_actions=response["suggested_actions"],
+            esi_level=response.get("esi_level"),
+            expected_resources=response.get("expected_resources", []),
+            vital_signs_concerns=response.get("vital_signs_concerns", [])
+        )
+        
+        assistant_turn = {
+            "role": "assistant",
+            "content": agent_response.response,
+            "timestamp": user_turn["timestamp"]
+        }
+        self._turn_tokens(assistant_turn)
+        
+        # Record both turns of the exchange in a single context write
+        await context_manager.append_turns(channel_input.user_id, [user_turn, assistant_turn])
+        
+        # Triage and queueing are in-memory and take microseconds, so they run
+        # inline: a thread hop would cost more than the work, and the queue's
+        # heaps are not safe to mutate from worker threads
+        triage_result = triage_engine.process(agent_response)
+        
+        # Add to queue if needed
+        if triage_result.requires_human_attention:
+            queue_item = QueueItem(
+                user_id=channel_input.user_id,
+                urgency_level=triage_result.urgency_level,
+                esi_level=triage_result.esi_level,
+                channel_type=channel_input.channel_type,
+                context_summary=await context_manager.get_context_summary(channel_input.user_id)
+            )
+            queue_manager.add_to_queue(queue_item)
+        
+        return agent_response, triage_result
+
     async def process_input(self, channel_input: ChannelInput) -> Tuple[AgentResponse, TriageResult]:
         with telemetry.tracer.start_as_current_span("process_input") as span:
-            start_time = time.time()
+            start_ns = time.perf_counter_ns()
             
             try:
-                # Get conversation context
-                context = await context_manager.get_context(channel_input.user_id)
-                
-                # Update context with user input
-                new_history = [
-                    *(context.conversation_history if context else []),
-                    {
-                        "role": "user",
-                        "content": channel_input.message,
-                        "timestamp": datetime.now()
-                    }
-                ]
-                await context_manager.create_or_update_context(
-                    user_id=channel_input.user_id,
-                    conversation_history=new_history
-                )
+                # Guideline retrieval runs while the context is read
+                guidelines_task = self._start_guidelines_retrieval(channel_input.message)
+                user_turn, recent_history = await self._load_recent_history(channel_input)
+                esi_guidelines_context = await guidelines_task if guidelines_task else ""
+                messages = self._build_messages(recent_history, esi_guidelines_context)
+                response = await self._get_ai_response(messages)
                 
-                # Retrieve relevant ESI guidelines for the patient's symptoms
-                esi_guidelines_context = ""
-                if pdf_knowledge_base.loaded:
-                    esi_guidelines_context = await pdf_knowledge_base.get_context_for_symptoms(channel_input.message)
-                
-                # Prepare conversation history for the AI
-                messages = [
-                    {"role": "system", "content": self.system_prompt}
-                ]
-                
-                # Add relevant ESI guidelines if available
-                if esi_guidelines_context:
-                    messages.append({
-                        "role": "system", 
-                        "content": f"Reference the following specific ESI guidelines when assessing this patient:\n\n{esi_guidelines_context}"
-                    })
+                agent_response, triage_result = await self._complete_exchange(channel_input, user_turn, response)
                 
-                # Add relevant conversation history
-                for msg in context.conversation_history[-5:]:  # Last 5 messages
-                    messages.append({
-                        "role": msg["role"],
-                        "content": msg["content"]
+                # Record metrics
+                processing_time = (time.perf_counter_ns() - start_ns) / 1e6
+                telemetry.record_response_time(processing_time, "agent_processor")
+                
+                if span.is_recording():
+                    span.set_attributes({
+                        "processor.triage_score": agent_response.triage_score,
+                        "processor.confidence_score": agent_response.confidence_score,
+                        "processor.urgency_level": triage_result.urgency_level.value,
+                        "processor.esi_level": triage_result.esi_level.value,
+                        "processor.requires_human": triage_result.requires_human_attention,
+                        "processor.processing_time_ms": processing_time,
+                        "processor.used_knowledge_base": bool(esi_guidelines_context)
                     })
                 
-                # Get AI response
-                response = self._get_ai_response(messages)
-                
-                # Create agent response
-                agent_response = AgentResponse(
-                    response=response["content"],
-                    triage_score=response["triage_score"],
-                    confidence_score=response["confidence"],
-                    suggested_actions=response["suggested_actions"],
-                    esi_level=response.get("esi_level"),
-                    expected_resources=response.get("expected_resources", []),
-                    vital_signs_concerns=response.get("vital_signs_concerns", [])
-                )
+                return agent_response, triage_result
                 
-                # Update context with agent response
-                new_history = [
-                    *(context.conversation_history if context else []),
-                    {
-                        "role": "assistant",
-                        "content": agent_response.response,
-                        "timestamp": datetime.now()
-                    }
-                ]
-                await context_manager.create_or_update_context(
-                    user_id=channel_input.user_id,
-                    conversation_history=new_history
-                )
+            except Exception as e:
+                if span.is_recording():
+                    span.set_status(Status(StatusCode.ERROR, str(e)))
+                raise
+
+    async def stream_input(self, channel_input: ChannelInput) -> AsyncIterator[str]:
+        """Process a new message, yielding the response text as it is generated.
+
+        The structured response is parsed once the stream completes, after which
+        the exchange is recorded and triaged exactly as in process_input.
+        """
+        with telemetry.tracer.start_as_current_span("stream_input") as span:
+            start_ns = time.perf_counter_ns()
+            
+            try:
+                guidelines_task = self._start_guidelines_retrieval(channel_input.message)
+                user_turn, recent_history = await self._load_recent_history(channel_input)
+                esi_guidelines_context = await guidelines_task if guidelines_task else ""
+                messages = self._build_messages(recent_history, esi_guidelines_context)
                 
-                # Process through triage engine
-                triage_result = triage_engine.process(agent_response)
+                content_stream = _JSONStringFieldStream("content")
+                arguments = []
+                async for fragment in self._stream_ai_response(messages):
+                    arguments.append(fragment)
+                    text = content_stream.feed(fragment)
+                    if text:
+                        yield text
                 
-                # Add to queue if needed
-                if triage_result.requires_human_attention:
-                    queue_item = QueueItem(
-                        user_id=channel_input.user_id,
-                        urgency_level=triage_result.urgency_level,
-                        esi_level=triage_result.esi_level,
-                        channel_type=channel_input.channel_type,
-                        context_summary=await context_manager.get_context_summary(channel_input.user_id)
-                    )
-                    queue_manager.add_to_queue(queue_item)
+                response = orjson.loads("".join(arguments))
+                agent_response, triage_result = await self._complete_exchange(channel_input, user_turn, response)
                 
                 # Record metrics
-                processing_time = (time.time() - start_time) * 1000
-                telemetry.record_response_time(processing_time, "agent_processor")
-                
-                span.set_attributes({
-                    "processor.triage_score": agent_response.triage_score,
-                    "processor.confidence_score": agent_response.confidence_score,
-                    "processor.urgency_level": triage_result.urgency_level.value,
-                    "processor.esi_level": triage_result.esi_level.value,
-                    "processor.requires_human": triage_result.requires_human_attention,
-                    "processor.processing_time_ms": processing_time,
-                    "processor.used_knowledge_base": bool(esi_guidelines_context)
-                })
+                processing_time = (time.perf_counter_ns() - start_ns) / 1e6
+                telemetry.record_response_time(processing_time, "agent_processor_stream")
                 
-                return agent_response, triage_result
+                if span.is_recording():
+                    span.set_attributes({
+                        "processor.triage_score": agent_response.triage_score,
+                        "processor.esi_level": triage_result.esi_level.value,
+                        "processor.requires_human": triage_result.requires_human_attention,
+                        "processor.processing_time_ms": processing_time,
+                        "processor.used_knowledge_base": bool(esi_guidelines_context)
+                    })
                 
             except Exception as e:
-                span.set_status(Status(StatusCode.ERROR, str(e)))
+                if span.is_recording():
+                    span.set_status(Status(StatusCode.ERROR, str(e)))
                 raise
 
-    def _get_ai_response(self, messages: list) -> dict:
+    async def _get_ai_response(self, messages: list) -> dict:
         """Get response from OpenAI API with structured output"""
         with telemetry.tracer.start_as_current_span("ai_request") as span:
             try:
-                response = self.client.chat.completions.create(
+                response = await self.client.chat.completions.create(
                     model=self.model,
                     messages=messages,
-                    functions=[{
-                        "name": "process_medical_inquiry",
-                        "description": "Process a medical inquiry and provide structured response with ESI triage",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "content": {
-                                    "type": "string",
-                                    "description": "The response message to the user"
-                                },
-                                "triage_score": {
-                                    "type": "number",
-                                    "description": "Urgency score from 0-1"
-                                },
-                                "esi_level": {
-                                    "type": "integer",
-                                    "enum": [1, 2, 3, 4, 5],
-                                    "description": "ESI triage level (1=most urgent, 5=least urgent)"
-                                },
-                                "confidence": {
-                                    "type": "number",
-                                    "description": "Confidence in the assessment from 0-1"
-                                },
-                                "suggested_actions": {
-                                    "type": "array",
-                                    "items": {"type": "string"},
-                                    "description": "List of suggested actions"
-                                },
-                                "expected_resources": {
-                                    "type": "array",
-                                    "items": {"type": "string"},
-                                    "description": "List of expected resources needed (lab_test, imaging, iv_fluids, medication, specialist_consult, procedure, none)"
-                                },
-                                "vital_signs_concerns": {
-                                    "type": "array",
-                                    "items": {"type": "string"},
-                                    "description": "List of vital sign concerns if any"
-                                }
-                            },
-                            "required": ["content", "triage_score", "esi_level", "confidence", "suggested_actions"]
-                        }
-                    }],
-                    function_call={"name": "process_medical_inquiry"}
+                    response_format=self._response_format
                 )
                 
-                # Parse the function call response
-                function_args = response.choices[0].message.function_call.arguments
-                function_response = json.loads(function_args)
+                # The schema is enforced server-side, so the content is the response object
+                ai_response = orjson.loads(response.choices[0].message.content)
+                
+                if span.is_recording():
+                    span.set_attributes({
+                        "ai.model": self.model,
+                        "ai.response_tokens": response.usage.total_tokens
+                    })
+                
+                return ai_response
+                
+            except Exception as e:
+                if span.is_recording():
+                    span.set_status(Status(StatusCode.ERROR, str(e)))
+                raise
+
+    async def _stream_ai_response(self, messages: list) -> AsyncIterator[str]:
+        """Stream the structured JSON response from OpenAI as it arrives"""
+        with telemetry.tracer.start_as_current_span("ai_stream_request") as span:
+            try:
+                stream = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    response_format=self._response_format,
+                    stream=True
+                )
                 
-                span.set_attributes({
-                    "ai.model": self.model,
-                    "ai.response_tokens": response.usage.total_tokens
-                })
+                chunk_count = 0
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    content = chunk.choices[0].delta.content
+                    if content:
+                        chunk_count += 1
+                        yield content
                 
-                return function_response
+                if span.is_recording():
+                    span.set_attributes({
+                        "ai.model": self.model,
+                        "ai.stream_chunks": chunk_count
+                    })
                 
             except Exception as e:
-                span.set_status(Status(StatusCode.ERROR, str(e)))
+                if span.is_recording():
+                    span.set_status(Status(StatusCode.ERROR, str(e)))
                 raise
 
 # Global instance
@@ -1,59 +1,134 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import APIRouter, FastAPI, HTTPException, Depends
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from .models import ChannelInput, AgentResponse, TriageResult, UrgencyLevel, PatientInfo
+from .models import ChannelInput, AgentResponse, TriageResult, UrgencyLevel, ESILevel, PatientInfo, InquiryReply, InquiryTriage
 from .agent_processor import agent_processor
 from .queue_manager import queue_manager
 from .context_manager import context_manager
 from .telemetry import telemetry
 from .critical_keywords import detect_critical_keywords
+from .pdf_knowledge_base import pdf_knowledge_base
 from opentelemetry import trace
 from opentelemetry.trace import Status, StatusCode
+import os
 import time
-from typing import Dict, Any, Optional
+import logging
+import asyncio
+import threading
+import orjson
+from contextlib import asynccontextmanager
+from typing import Annotated, Dict, Any, Optional, Set
 from datetime import datetime, timedelta
 import jwt
+from cachetools import TTLCache
 from passlib.context import CryptContext
 import uuid
 
+logger = logging.getLogger(__name__)
+
 # Security setup - simplified for mockup
 SECRET_KEY = "nhs_digital_front_desk_mock_secret_key"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 120  # Extended for easier testing
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# jwt.decode arguments, built once instead of on every authenticated request
+_JWT_DECODE_KW = {
+    "algorithms": [ALGORITHM],
+    "options": {"require": ["sub", "exp"]}
+}
+
+# Decoded token claims and their expiry, so repeat requests with the same token skip jwt.decode
+_token_cache: TTLCache = TTLCache(maxsize=4096, ttl=5)
+
+# In mock mode bcrypt runs at 4 rounds instead of passlib's default 12: hashes are
+# 256x cheaper to compute, which is only acceptable for the mock user database.
+# Set MOCK_MODE=0 to restore the default cost factor.
+MOCK_MODE = os.getenv("MOCK_MODE", "1") == "1"
+if MOCK_MODE:
+    pwd_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4, deprecated="auto")
+else:
+    pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Serializes first-login hashing: logins read hashed_password from threadpool workers
+_hash_lock = threading.Lock()
+
+class LazyHashedUser(dict):
+    """Mock user record that hashes its plain password on first access to hashed_password"""
+
+    def __missing__(self, key):
+        if key != "hashed_password":
+            raise KeyError(key)
+        with _hash_lock:
+            # A concurrent login may have hashed the password while we waited
+            if key not in self:
+                if "password" not in self:
+                    raise KeyError(key)
+                self[key] = pwd_context.hash(self.pop("password"))
+        return dict.__getitem__(self, key)
+
 # Simple mock user database with predefined test users
+# bcrypt hashing is deferred to the first login so it does not slow down import
 fake_users_db = {
-    "test-user-1": {
+    "test-user-1": LazyHashedUser({
         "username": "demo_patient",
-        "hashed_password": pwd_context.hash("password123"),
+        "password": "password123",
         "user_id": "test-user-1",
         "full_name": "Demo Patient",
         "email": "demo@example.com"
-    },
-    "test-user-2": {
+    }),
+    "test-user-2": LazyHashedUser({
         "username": "test_user",
-        "hashed_password": pwd_context.hash("test123"),
+        "password": "test123",
         "user_id": "test-user-2",
         "full_name": "Test User",
         "email": "test@example.com"
-    },
-    "admin-user": {
+    }),
+    "admin-user": LazyHashedUser({
         "username": "admin",
-        "hashed_password": pwd_context.hash("admin123"),
+        "password": "admin123",
         "user_id": "admin-user",
         "full_name": "Admin User",
         "email": "admin@example.com",
         "is_admin": True
-    }
+    })
 }
 
+# Index of the same user records by username, kept in sync by /register
+fake_users_by_username: Dict[str, dict] = {user["username"]: user for user in fake_users_db.values()}
+# Usernames whose registration is hashing its password, so a concurrent one can't claim them
+_pending_usernames: Set[str] = set()
+
+async def cleanup_task():
+    """Periodic task to clean up old contexts"""
+    while True:
+        await asyncio.sleep(3600)  # Run every hour
+        context_manager.cleanup_old_contexts()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Embed the ESI guidelines once at startup so inquiries only embed their query
+    await pdf_knowledge_base.initialize()
+    await agent_processor.load_encoding()
+    
+    # Background tasks are started here so that every worker process runs its own
+    background_tasks = [
+        asyncio.create_task(cleanup_task())
+    ]
+    yield
+    for task in background_tasks:
+        task.cancel()
+    # Closing the client also closes its pooled httpx connections
+    await agent_processor.client.close()
+
 app = FastAPI(
     title="Digital Front Desk & Triage Agent",
     description="AI-powered medical front desk system for patient triage and routing",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Add CORS middleware
@@ -65,6 +140,12 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+# Endpoints are grouped into routers that are included into the app once, below
+auth_router = APIRouter(tags=["auth"])
+context_router = APIRouter(tags=["context"])
+inquiry_router = APIRouter(tags=["inquiries"])
+queue_router = APIRouter(tags=["queue"])
+
 # Authentication functions - simplified for mockup
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -72,6 +153,10 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+def verify_user_password(user: dict, plain_password: str) -> bool:
+    # Reading hashed_password may hash a mock user's password on first login
+    return verify_password(plain_password, user["hashed_password"])
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -82,14 +167,25 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def _decode_token(token: str) -> dict:
+    """Decode a token, reusing the claims of a recent decode of the same token"""
+    cached = _token_cache.get(token)
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
+    
+    # Claim presence is checked in the same pass as the signature
+    payload = jwt.decode(token, SECRET_KEY, **_JWT_DECODE_KW)
+    _token_cache[token] = (payload, payload["exp"])
+    return payload
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     try:
         # For mockup purposes, we'll simplify token validation
         # In production, you would properly validate the token
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
+        payload = _decode_token(token)
+        user_id: str = payload["sub"]
         
-        if user_id is None or user_id not in fake_users_db:
+        if user_id not in fake_users_db:
             # For testing purposes, allow a fallback test user if token validation fails
             # This would be removed in production
             return {"user_id": "test-user-1"}
@@ -101,17 +197,26 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         # In production, you would properly handle this error
         return {"user_id": "test-user-1"}
 
+# Shared dependency alias so every endpoint resolves the same cached dependency node
+CurrentUser = Annotated[dict, Depends(get_current_user)]
+
 # Authentication endpoints - simplified for mockup
-@app.post("/register")
+@auth_router.post("/register")
 async def register_user(form_data: OAuth2PasswordRequestForm = Depends()):
     with telemetry.tracer.start_as_current_span("register_user") as span:
         # For mockup, check if username exists in any user
-        username_exists = any(user["username"] == form_data.username for user in fake_users_db.values())
-        if username_exists:
+        username = form_data.username
+        if username in fake_users_by_username or username in _pending_usernames:
             raise HTTPException(status_code=400, detail="Username already registered")
         
         user_id = str(uuid.uuid4())
-        hashed_password = get_password_hash(form_data.password)
+        # bcrypt is CPU-bound, so hash in the thread pool to keep the event loop free;
+        # the username stays reserved across the await
+        _pending_usernames.add(username)
+        try:
+            hashed_password = await run_in_threadpool(get_password_hash, form_data.password)
+        finally:
+            _pending_usernames.discard(username)
         
         user_data = {
             "username": form_data.username,
@@ -122,27 +227,25 @@ async def register_user(form_data: OAuth2PasswordRequestForm = Depends()):
         }
         
         fake_users_db[user_id] = user_data
+        fake_users_by_username[form_data.username] = user_data
         
         # Create initial context for the user
         await context_manager.create_or_update_context(user_id, [], {})
         
-        span.set_attributes({
-            "user.id": user_id,
-            "user.username": form_data.username
-        })
+        if span.is_recording():
+            span.set_attributes({
+                "user.id": user_id,
+                "user.username": form_data.username
+            })
         
-        print(f"Mock registration successful: {form_data.username} (ID: {user_id})")
+        logger.debug("Mock registration successful: %s (ID: %s)", form_data.username, user_id)
         return {"message": "User registered successfully", "user_id": user_id}
 
-@app.post("/token")
+@auth_router.post("/token")
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
     with telemetry.tracer.start_as_current_span("login_user") as span:
         # For mockup purposes, find the user by username
-        user = None
-        for u in fake_users_db.values():
-            if u["username"] == form_data.username:
-                user = u
-                break
+        user = fake_users_by_username.get(form_data.username)
         
         # For demo/testing, allow a special "auto login" username that doesn't require a password check
         if form_data.username == "auto_login":
@@ -151,11 +254,11 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
             access_token = create_access_token(
                 data={"sub": user["user_id"]}, expires_delta=access_token_expires
             )
-            print(f"Mock auto-login successful: {user['username']} (ID: {user['user_id']})")
+            logger.debug("Mock auto-login successful: %s (ID: %s)", user["username"], user["user_id"])
             return {"access_token": access_token, "token_type": "bearer", "user_id": user["user_id"]}
         
         # Regular login check
-        if not user or not verify_password(form_data.password, user["hashed_password"]):
+        if not user or not await run_in_threadpool(verify_user_password, user, form_data.password):
             raise HTTPException(
                 status_code=401,
                 detail="Incorrect username or password",
@@ -167,19 +270,20 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
             data={"sub": user["user_id"]}, expires_delta=access_token_expires
         )
         
-        span.set_attributes({
-            "user.id": user["user_id"],
-            "user.username": user["username"]
-        })
+        if span.is_recording():
+            span.set_attributes({
+                "user.id": user["user_id"],
+                "user.username": user["username"]
+            })
         
-        print(f"Mock login successful: {user['username']} (ID: {user['user_id']})")
+        logger.debug("Mock login successful: %s (ID: %s)", user["username"], user["user_id"])
         return {"access_token": access_token, "token_type": "bearer", "user_id": user["user_id"]}
 
 # For mockup testing - endpoint to get all users (would be removed in production)
-@app.get("/debug/users")
+@auth_router.get("/debug/users")
 async def get_all_users():
     """Debug endpoint to see all registered users - would be removed in production"""
-    return [
+    return ORJSONResponse([
         {
             "user_id": user_id,
             "username": user_data["username"],
@@ -187,57 +291,48 @@ async def get_all_users():
             "email": user_data.get("email", "")
         } 
         for user_id, user_data in fake_users_db.items()
-    ]
+    ])
 
 # Patient information endpoint - simplified for mockup
-@app.post("/patient-info")
-async def update_patient_info(patient_info: PatientInfo, current_user = Depends(get_current_user)):
+@context_router.post("/patient-info")
+async def update_patient_info(patient_info: PatientInfo, current_user: CurrentUser):
     with telemetry.tracer.start_as_current_span("update_patient_info") as span:
         user_id = current_user["user_id"]
         
         # For mockup, we'll be more permissive with user ID mismatches
         if patient_info.user_id != user_id:
-            print(f"User ID mismatch in patient info: {patient_info.user_id} vs {user_id}")
+            logger.debug("User ID mismatch in patient info: %s vs %s", patient_info.user_id, user_id)
             patient_info.user_id = user_id  # Correct the ID for mockup
         
         # Update the context with patient info
-        context = await context_manager.get_context(user_id)
-        if not context:
-            context = await context_manager.create_or_update_context(user_id, [])
+        await context_manager.set_patient_info(user_id, patient_info)
         
-        context.patient_info = patient_info
-        await context_manager.create_or_update_context(
-            user_id, 
-            context.conversation_history, 
-            context.metadata,
-            patient_info
-        )
-        
-        span.set_attributes({
-            "user.id": user_id,
-            "patient.age": patient_info.age or 0,
-            "patient.sex": patient_info.sex or "unknown"
-        })
+        if span.is_recording():
+            span.set_attributes({
+                "user.id": user_id,
+                "patient.age": patient_info.age or 0,
+                "patient.sex": patient_info.sex or "unknown"
+            })
         
-        print(f"Mock patient info updated for: {user_id}")
+        logger.debug("Mock patient info updated for: %s", user_id)
         return {"message": "Patient information updated successfully"}
 
-@app.post("/inquiries", response_model=Dict[str, Any])
-async def process_inquiry(channel_input: ChannelInput, current_user = Depends(get_current_user)):
+@inquiry_router.post("/inquiries", response_model=InquiryReply)
+async def process_inquiry(channel_input: ChannelInput, current_user: CurrentUser):
     """Process a new patient inquiry"""
     with telemetry.tracer.start_as_current_span("http_process_inquiry") as span:
         try:
-            start_time = time.time()
+            start_ns = time.perf_counter_ns()
             
             user_id = current_user["user_id"]
             if channel_input.user_id != user_id:
                 raise HTTPException(status_code=400, detail="User ID mismatch")
             
-            # Check for critical keywords
+            # The keyword scan is synchronous and cached, so it runs before the agent
             critical_keywords = detect_critical_keywords(channel_input.message)
             
             try:
-                # Try to process through agent
+                # Try to process through agent, which retrieves the ESI guidelines while it reads the context
                 agent_response, triage_result = await agent_processor.process_input(channel_input)
             except Exception as agent_error:
                 # Fallback response if agent processing fails
@@ -245,6 +340,7 @@ async def process_inquiry(channel_input: ChannelInput, current_user = Depends(ge
                     # Create a basic response for critical conditions
                     triage_result = TriageResult(
                         urgency_level=UrgencyLevel.CRITICAL,
+                        esi_level=ESILevel.LEVEL_1,
                         recommended_action="Immediate medical attention required",
                         reasoning="Critical keywords detected in message",
                         requires_human_attention=True
@@ -265,44 +361,51 @@ async def process_inquiry(channel_input: ChannelInput, current_user = Depends(ge
                 triage_result.requires_human_attention = True
             
             # Record request processing time
-            processing_time = (time.time() - start_time) * 1000
+            processing_time = (time.perf_counter_ns() - start_ns) / 1e6
             telemetry.record_response_time(processing_time, "http_request")
             
-            span.set_attributes({
-                "http.status_code": 200,
-                "http.processing_time_ms": processing_time,
-                "critical_keywords_found": len(critical_keywords) > 0
-            })
+            if span.is_recording():
+                span.set_attributes({
+                    "http.status_code": 200,
+                    "http.processing_time_ms": processing_time,
+                    "critical_keywords_found": len(critical_keywords) > 0
+                })
             
-            return {
-                "response": agent_response.response,
-                "triage_result": {
-                    "urgency_level": triage_result.urgency_level.name,
-                    "recommended_action": triage_result.recommended_action,
-                    "requires_human_attention": triage_result.requires_human_attention,
-                    "critical_keywords_detected": critical_keywords if critical_keywords else []
-                },
-                "suggested_actions": agent_response.suggested_actions
-            }
+            # Serialize straight to JSON bytes, bypassing jsonable_encoder
+            reply = InquiryReply(
+                response=agent_response.response,
+                triage_result=InquiryTriage(
+                    urgency_level=triage_result.urgency_level.name,
+                    recommended_action=triage_result.recommended_action,
+                    requires_human_attention=triage_result.requires_human_attention,
+                    critical_keywords_detected=critical_keywords
+                ),
+                suggested_actions=agent_response.suggested_actions
+            )
+            return Response(content=reply.model_dump_json(), media_type="application/json")
             
         except Exception as e:
-            span.set_status(Status(StatusCode.ERROR, str(e)))
+            if span.is_recording():
+                span.set_status(Status(StatusCode.ERROR, str(e)))
             raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/queue/status")
+@queue_router.get("/queue/status")
 async def get_queue_status():
     """Get current queue status"""
     with telemetry.tracer.start_as_current_span("http_queue_status") as span:
         try:
             status = queue_manager.get_queue_status()
-            span.set_attributes({"http.status_code": 200})
-            return status
+            if span.is_recording():
+                span.set_attributes({"http.status_code": 200})
+            # orjson encodes the UrgencyLevel keys directly, so skip jsonable_encoder
+            return ORJSONResponse(status)
         except Exception as e:
-            span.set_status(Status(StatusCode.ERROR, str(e)))
+            if span.is_recording():
+                span.set_status(Status(StatusCode.ERROR, str(e)))
             raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/context/{user_id}")
-async def get_user_context(user_id: str, current_user = Depends(get_current_user)):
+@context_router.get("/context/{user_id}")
+async def get_user_context(user_id: str, current_user: CurrentUser):
     """Get the context for a user"""
     with telemetry.tracer.start_as_current_span("get_user_context") as span:
         try:
@@ -315,89 +418,106 @@ async def get_user_context(user_id: str, current_user = Depends(get_current_user
             if not context:
                 raise HTTPException(status_code=404, detail="Context not found")
                 
-            span.set_attributes({
-                "user.id": user_id,
-                "context.history_length": len(context.conversation_history),
-                "has_patient_info": context.patient_info is not None
-            })
+            if span.is_recording():
+                span.set_attributes({
+                    "user.id": user_id,
+                    "context.history_length": len(context.conversation_history),
+                    "has_patient_info": context.patient_info is not None
+                })
                 
             return {
                 "user_id": context.user_id,
-                "last_updated": context.last_updated.isoformat(),
+                "last_updated": datetime.fromtimestamp(context.last_updated).isoformat(),
                 "history_length": len(context.conversation_history),
-                "patient_info": context.patient_info.dict() if context.patient_info else None
+                "patient_info": context.patient_info_dict()
             }
         except Exception as e:
-            span.set_status(Status(StatusCode.ERROR, str(e)))
+            if span.is_recording():
+                span.set_status(Status(StatusCode.ERROR, str(e)))
             raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/queue/next")
+@queue_router.post("/queue/next")
 async def get_next_queue_item():
     """Get the next item from the queue"""
     with telemetry.tracer.start_as_current_span("http_queue_next") as span:
         try:
             item = queue_manager.get_next_item()
             if item:
-                span.set_attributes({
-                    "http.status_code": 200,
-                    "queue.item_found": True,
-                    "queue.urgency_level": item.urgency_level.value
-                })
+                if span.is_recording():
+                    span.set_attributes({
+                        "http.status_code": 200,
+                        "queue.item_found": True,
+                        "queue.urgency_level": item.urgency_level.value
+                    })
                 return {
                     "user_id": item.user_id,
                     "urgency_level": item.urgency_level.name,
-                    "wait_time": (time.time() - item.timestamp.timestamp()),
+                    "wait_time": time.monotonic() - item.timestamp,
                     "channel_type": item.channel_type,
                     "context_summary": item.context_summary
                 }
             else:
-                span.set_attributes({
-                    "http.status_code": 404,
-                    "queue.item_found": False
-                })
+                if span.is_recording():
+                    span.set_attributes({
+                        "http.status_code": 404,
+                        "queue.item_found": False
+                    })
                 raise HTTPException(status_code=404, detail="No items in queue")
         except Exception as e:
-            span.set_status(Status(StatusCode.ERROR, str(e)))
+            if span.is_recording():
+                span.set_status(Status(StatusCode.ERROR, str(e)))
             raise HTTPException(status_code=500, detail=str(e))
 
-@app.delete("/queue/{user_id}")
+@queue_router.delete("/queue/{user_id}")
 async def remove_from_queue(user_id: str):
     """Remove a user from the queue"""
     with telemetry.tracer.start_as_current_span("http_queue_remove") as span:
         try:
             queue_manager.remove_from_queue(user_id)
-            span.set_attributes({
-                "http.status_code": 200,
-                "queue.user_id": user_id
-            })
+            if span.is_recording():
+                span.set_attributes({
+                    "http.status_code": 200,
+                    "queue.user_id": user_id
+                })
             return {"status": "success", "message": f"User {user_id} removed from queue"}
         except Exception as e:
-            span.set_status(Status(StatusCode.ERROR, str(e)))
+            if span.is_recording():
+                span.set_status(Status(StatusCode.ERROR, str(e)))
             raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/chat")
+@inquiry_router.post("/chat")
 async def chat(channel_input: ChannelInput):
-    """Process a chat message"""
-    with telemetry.tracer.start_as_current_span("http_chat") as span:
-        try:
-            start_time = time.time()
-            
-            # Process the input through our agent
-            agent_response, _ = await agent_processor.process_input(channel_input)
-            
-            # Record request processing time
-            processing_time = (time.time() - start_time) * 1000
-            telemetry.record_response_time(processing_time, "chat_request")
-            
-            span.set_attributes({
-                "http.status_code": 200,
-                "http.processing_time_ms": processing_time
-            })
-            
-            return {
-                "response": agent_response.response
-            }
-            
-        except Exception as e:
-            span.set_status(Status(StatusCode.ERROR, str(e)))
-            raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+    """Process a chat message, streaming the response as server-sent events"""
+    async def event_stream():
+        with telemetry.tracer.start_as_current_span("http_chat") as span:
+            try:
+                start_ns = time.perf_counter_ns()
+                first_token_time = None
+                
+                # Stream the response text as our agent generates it
+                async for text in agent_processor.stream_input(channel_input):
+                    if first_token_time is None:
+                        first_token_time = (time.perf_counter_ns() - start_ns) / 1e6
+                    yield f"data: {orjson.dumps({'response': text}).decode()}\n\n"
+                
+                # Record request processing time
+                processing_time = (time.perf_counter_ns() - start_ns) / 1e6
+                telemetry.record_response_time(processing_time, "chat_request")
+                
+                if span.is_recording():
+                    span.set_attributes({
+                        "http.status_code": 200,
+                        "http.processing_time_ms": processing_time,
+                        "http.time_to_first_token_ms": first_token_time or processing_time
+                    })
+                
+            except Exception as e:
+                # Headers are already sent, so report the failure in-band
+                if span.is_recording():
+                    span.set_status(Status(StatusCode.ERROR, str(e)))
+                yield f"event: error\ndata: {orjson.dumps({'detail': str(e)}).decode()}\n\n"
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+for router in (auth_router, context_router, inquiry_router, queue_router):
+    app.include_router(router)
@@ -1,27 +1,48 @@
-from .models import ConversationContext, ChannelInput, AgentResponse, PatientInfo
+from .models import ConversationContext, ChannelInput, AgentResponse, PatientInfo, MAX_HISTORY_LENGTH
 from .telemetry import telemetry
 from typing import Dict, Optional, List
-from datetime import datetime, timedelta
+from datetime import timedelta
+from collections import deque
+from cachetools import TTLCache
 import asyncio
 import json
 import time
 
+CONTEXT_TTL = timedelta(hours=24)  # Context time-to-live
+MAX_CONTEXTS = 10_000
+
 # In-memory store for conversation contexts
 # In a production environment, this would be a database
-contexts: Dict[str, ConversationContext] = {}
+# Bounded, and entries expire CONTEXT_TTL after their last write; every update
+# re-assigns its entry so that active conversations are kept alive
+contexts: Dict[str, ConversationContext] = TTLCache(
+    maxsize=MAX_CONTEXTS,
+    ttl=CONTEXT_TTL.total_seconds()
+)
+
+# Metric instruments are created once and reused for every update
+_CONV_LEN_HIST = telemetry.meter.create_histogram(
+    name="context.conversation_length",
+    description="Number of messages in conversation",
+    unit="1"
+)
+_CTX_AGE_HIST = telemetry.meter.create_histogram(
+    name="context.age",
+    description="Age of context in seconds",
+    unit="s"
+)
 
 class ContextManager:
     def __init__(self):
-        self.context_ttl = timedelta(hours=24)  # Context time-to-live
+        self.context_ttl = CONTEXT_TTL
 
     async def get_context(self, user_id: str) -> Optional[ConversationContext]:
         """Retrieve the conversation context for a user"""
         with telemetry.tracer.start_as_current_span("get_context") as span:
-            span.set_attributes({"user.id": user_id})
+            if span.is_recording():
+                span.set_attributes({"user.id": user_id})
             
-            if user_id in contexts:
-                return contexts[user_id]
-            return None
+            return contexts.get(user_id)
     
     async def create_or_update_context(
         self, 
@@ -34,27 +55,30 @@ class ContextManager:
         with telemetry.tracer.start_as_current_span("update_context") as span:
             start_time = time.time()
             
-            span.set_attributes({
-                "user.id": user_id,
-                "context.history_length": len(conversation_history)
-            })
+            if span.is_recording():
+                span.set_attributes({
+                    "user.id": user_id,
+                    "context.history_length": len(conversation_history)
+                })
             
             # Check if the context already exists
-            if user_id in contexts:
+            context = contexts.get(user_id)
+            if context is not None:
                 # Update existing context
-                contexts[user_id].conversation_history = conversation_history
-                contexts[user_id].last_updated = datetime.now()
-                contexts[user_id].metadata.update(metadata)
+                context.conversation_history = deque(conversation_history, maxlen=MAX_HISTORY_LENGTH)
+                context.last_updated = time.time()
+                context.metadata.update(metadata)
                 if patient_info:
-                    contexts[user_id].patient_info = patient_info
+                    context.patient_info = patient_info
             else:
                 # Create new context
-                contexts[user_id] = ConversationContext(
+                context = ConversationContext(
                     user_id=user_id,
                     conversation_history=conversation_history,
                     metadata=metadata,
                     patient_info=patient_info
                 )
+            contexts[user_id] = context
             
             # Record update time
             telemetry.record_response_time(
@@ -62,15 +86,66 @@ class ContextManager:
                 "context_update"
             )
             
-            return contexts[user_id]
+            return context
+    
+    async def append_turns(self, user_id: str, turns: List[dict]) -> ConversationContext:
+        """Append the turns of one exchange to the conversation history in a single write"""
+        with telemetry.tracer.start_as_current_span("append_turns") as span:
+            start_time = time.time()
+            
+            if span.is_recording():
+                span.set_attributes({
+                    "user.id": user_id,
+                    "context.turns_appended": len(turns)
+                })
+            
+            context = contexts.get(user_id)
+            if context is not None:
+                context.conversation_history.extend(turns)
+                context.last_updated = time.time()
+            else:
+                context = ConversationContext(
+                    user_id=user_id,
+                    conversation_history=list(turns)
+                )
+            contexts[user_id] = context
+            
+            # Record update time
+            telemetry.record_response_time(
+                (time.time() - start_time) * 1000,
+                "context_update"
+            )
+            
+            return context
+    
+    async def set_patient_info(self, user_id: str, patient_info: PatientInfo) -> ConversationContext:
+        """Set the patient info on a user's context in place, creating the context if needed"""
+        with telemetry.tracer.start_as_current_span("set_patient_info") as span:
+            if span.is_recording():
+                span.set_attributes({"user.id": user_id})
+            
+            context = contexts.get(user_id)
+            if context is not None:
+                context.patient_info = patient_info
+                context.last_updated = time.time()
+            else:
+                context = ConversationContext(
+                    user_id=user_id,
+                    conversation_history=[],
+                    patient_info=patient_info
+                )
+            contexts[user_id] = context
+            
+            return context
     
     async def append_to_history(self, user_id: str, message: dict) -> None:
         """Append a new message to the conversation history"""
         with telemetry.tracer.start_as_current_span("append_history") as span:
-            span.set_attributes({
-                "user.id": user_id,
-                "message.role": message.get("role", "unknown")
-            })
+            if span.is_recording():
+                span.set_attributes({
+                    "user.id": user_id,
+                    "message.role": message.get("role", "unknown")
+                })
             
             # Get the current context
             context = await self.get_context(user_id)
@@ -79,24 +154,23 @@ class ContextManager:
                 # Create a new context if it doesn't exist
                 context = await self.create_or_update_context(user_id, [])
             
-            # Append the message
+            # Append the message; the bounded deque drops the oldest turn itself
             context.conversation_history.append(message)
-            context.last_updated = datetime.now()
-            
-            # Limit history size
-            if len(context.conversation_history) > 20:
-                context.conversation_history = context.conversation_history[-20:]
+            context.last_updated = time.time()
             
-            # No need to call create_or_update_context as we've modified the object in-place
+            # Re-assign the entry to restart its TTL
+            contexts[user_id] = context
     
     async def clear_context(self, user_id: str) -> None:
         """Clear the conversation context for a user"""
         with telemetry.tracer.start_as_current_span("clear_context") as span:
-            span.set_attributes({"user.id": user_id})
+            if span.is_recording():
+                span.set_attributes({"user.id": user_id})
             
-            if user_id in contexts:
+            context = contexts.get(user_id)
+            if context is not None:
                 # Preserve patient info when clearing context
-                patient_info = contexts[user_id].patient_info
+                patient_info = context.patient_info
                 contexts[user_id] = ConversationContext(
                     user_id=user_id,
                     conversation_history=[],
@@ -108,19 +182,15 @@ class ContextManager:
     def cleanup_old_contexts(self):
         """Remove expired contexts to free up memory"""
         with telemetry.tracer.start_as_current_span("context_cleanup") as span:
-            current_time = datetime.now()
-            expired_contexts = [
-                user_id for user_id, context in contexts.items()
-                if current_time - context.last_updated > self.context_ttl
-            ]
-            
-            for user_id in expired_contexts:
-                del contexts[user_id]
-            
-            span.set_attributes({
-                "context.cleaned_count": len(expired_contexts),
-                "context.remaining_count": len(contexts)
-            })
+            # The TTL cache drops expired entries lazily; expire() purges them all now
+            count_before = len(contexts)
+            contexts.expire()
+            
+            if span.is_recording():
+                span.set_attributes({
+                    "context.cleaned_count": count_before - len(contexts),
+                    "context.remaining_count": len(contexts)
+                })
 
     async def get_context_summary(self, user_id: str) -> str:
         """Generate a summary of the conversation context"""
@@ -128,7 +198,7 @@ class ContextManager:
         if not context or not context.conversation_history:
             return "No conversation history"
         
-        last_messages = context.conversation_history[-3:]  # Get last 3 messages
+        last_messages = context.recent_history(3)  # Get last 3 messages
         summary = []
         
         for msg in last_messages:
@@ -141,19 +211,11 @@ class ContextManager:
 
     def _record_context_metrics(self, context: ConversationContext):
         # Record conversation length
-        telemetry.meter.create_histogram(
-            name="context.conversation_length",
-            description="Number of messages in conversation",
-            unit="1"
-        ).record(len(context.conversation_history))
+        _CONV_LEN_HIST.record(len(context.conversation_history))
         
         # Record context age
-        age = (datetime.now() - context.last_updated).total_seconds()
-        telemetry.meter.create_histogram(
-            name="context.age",
-            description="Age of context in seconds",
-            unit="s"
-        ).record(age)
+        age = time.time() - context.last_updated
+        _CTX_AGE_HIST.record(age)
 
 # Global instance
 context_manager = ContextManager() 
\ No newline at end of file
@@ -1,6 +1,18 @@
-from typing import Set, Dict, List, Tuple
+from typing import Set, Dict, FrozenSet, List, Optional, Tuple
+from functools import lru_cache, wraps
+from itertools import accumulate
 import re
 
+try:
+    import ahocorasick
+except ImportError:  # C extension unavailable; fall back to a compiled regex
+    ahocorasick = None
+
+try:
+    import hyperscan
+except ImportError:  # Optional; only built for x86-64 Linux
+    hyperscan = None
+
 # ESI Level 1: Immediate life-saving intervention required
 ESI_LEVEL_1_KEYWORDS: Dict[str, List[str]] = {
     "cardiac arrest": [],
@@ -131,121 +143,278 @@ PEDIATRIC_KEYWORDS: Dict[str, List[str]] = {
     "child not drinking": [],
 }
 
-def detect_critical_keywords(text: str) -> List[str]:
+_KeywordEntry = Tuple[str, Tuple[str, ...], str]
+
+def _lowercased(keywords: Dict[str, List[str]]) -> Tuple[_KeywordEntry, ...]:
+    """Freeze a keyword dict into (keyword, contexts, original keyword) tuples, lowercased"""
+    return tuple(
+        (keyword.lower(), tuple(context.lower() for context in contexts), keyword)
+        for keyword, contexts in keywords.items()
+    )
+
+# The keyword dicts are static, so lowercase them once at import
+_ESI_LEVEL_1_KEYWORDS_LC = _lowercased(ESI_LEVEL_1_KEYWORDS)
+_ESI_LEVEL_2_KEYWORDS_LC = _lowercased(ESI_LEVEL_2_KEYWORDS)
+_RESOURCE_KEYWORDS_LC = _lowercased(RESOURCE_KEYWORDS)
+_VITAL_SIGN_KEYWORDS_LC = _lowercased(VITAL_SIGN_KEYWORDS)
+_PEDIATRIC_KEYWORDS_LC = _lowercased(PEDIATRIC_KEYWORDS)
+
+def _resource_category(keyword: str) -> Optional[str]:
+    """Map a resource keyword to the resource category it implies"""
+    if any(lab_term in keyword for lab_term in ["blood", "urine", "lab", "test", "culture"]):
+        return "lab"
+    elif any(imaging_term in keyword for imaging_term in ["x-ray", "ultrasound", "ct", "mri"]):
+        return "imaging"
+    elif any(iv_term in keyword for iv_term in ["iv", "intravenous"]):
+        return "iv"
+    elif any(procedure_term in keyword for procedure_term in ["stitches", "sutures", "wound", "splint", "cast", "drainage", "intubation", "catheter"]):
+        return "procedure"
+    elif any(specialist_term in keyword for specialist_term in ["specialist", "cardiology", "neurology", "orthopedics", "surgery", "obgyn", "pediatric"]):
+        return "specialist"
+    return None
+
+# Resource keywords are static, so categorize them once at import
+_KEYWORD_TO_CATEGORY: Dict[str, str] = {
+    keyword: category
+    for keyword in RESOURCE_KEYWORDS
+    if (category := _resource_category(keyword)) is not None
+}
+
+_CONTEXT_TAG = "CTX"
+
+# Match tag -> keyword table; context words of every table are tagged _CONTEXT_TAG
+_KEYWORD_TABLES: Dict[str, Tuple[_KeywordEntry, ...]] = {
+    "ESI1": _ESI_LEVEL_1_KEYWORDS_LC,
+    "ESI2": _ESI_LEVEL_2_KEYWORDS_LC,
+    "RES": _RESOURCE_KEYWORDS_LC,
+    "VIT": _VITAL_SIGN_KEYWORDS_LC,
+    "PED": _PEDIATRIC_KEYWORDS_LC,
+}
+
+# All tables flattened, in table order, into parallel tuples (one slot per keyword)
+_ALL_TAGS: Tuple[str, ...] = tuple(tag for tag, entries in _KEYWORD_TABLES.items() for _ in entries)
+_ALL_KEYWORDS: Tuple[str, ...] = tuple(keyword for entries in _KEYWORD_TABLES.values() for keyword, _, _ in entries)
+_ALL_CONTEXTS: Tuple[Tuple[str, ...], ...] = tuple(contexts for entries in _KEYWORD_TABLES.values() for _, contexts, _ in entries)
+# Reported form of each keyword: critical keywords carry their ESI level prefix
+_ALL_LABELS: Tuple[str, ...] = tuple(
+    f"{tag}:{original}" if tag in ("ESI1", "ESI2") else original
+    for tag, entries in _KEYWORD_TABLES.items()
+    for _, _, original in entries
+)
+
+_Match = Tuple[str, str]  # (tag, lowercased keyword or context word)
+
+# Slot of each (tag, keyword) in the flattened tuples
+_ENTRY_INDEX: Dict[_Match, int] = {match: i for i, match in enumerate(zip(_ALL_TAGS, _ALL_KEYWORDS))}
+
+class _RegexMatcher:
     """
-    Detect critical keywords in the given text.
-    Returns a list of detected critical keywords.
+    Automaton-compatible matcher used when pyahocorasick is not installed.
+    One precompiled alternation finds the longest pattern starting at each
+    position; every shorter pattern that is a prefix of it matches there too.
     """
-    text = text.lower()
-    detected_keywords = []
-    
-    # Check ESI Level 1 keywords (most critical)
-    for keyword, contexts in ESI_LEVEL_1_KEYWORDS.items():
-        if keyword.lower() in text:
-            # If keyword has no specific context requirements
-            if not contexts:
-                detected_keywords.append(f"ESI1:{keyword}")
-            # If keyword has context requirements, check if any context is present
-            elif any(context.lower() in text for context in contexts):
-                detected_keywords.append(f"ESI1:{keyword}")
+
+    def __init__(self, patterns: Dict[str, tuple]):
+        ordered = sorted(patterns, key=len, reverse=True)
+        # Zero-width lookahead so overlapping matches are all reported
+        self._regex = re.compile("(?=(%s))" % "|".join(map(re.escape, ordered)))
+        self._matches = {
+            pattern: tuple(
+                match
+                for prefix in ordered if pattern.startswith(prefix)
+                for match in patterns[prefix]
+            )
+            for pattern in patterns
+        }
+
+    def iter(self, text: str):
+        for match in self._regex.finditer(text):
+            pattern = match.group(1)
+            yield match.start() + len(pattern) - 1, self._matches[pattern]
+
+class _HyperscanMatcher:
+    """
+    Automaton-compatible matcher on a Hyperscan literal database, used when
+    hyperscan is installed. Its SIMD scan reports every occurrence of every
+    pattern, at byte offsets into the UTF-8 encoded text.
+    """
+
+    def __init__(self, patterns: Dict[str, tuple]):
+        self._values = list(patterns.values())
+        self._database = hyperscan.Database()
+        self._database.compile(
+            expressions=[pattern.encode() for pattern in patterns],
+            ids=list(range(len(patterns))),
+            elements=len(patterns),
+            flags=0,
+            literal=True
+        )
+
+    def iter(self, text: str):
+        found = []
+        def on_match(pattern_id, start, end, flags, context):
+            found.append((end - 1, self._values[pattern_id]))
+        encoded = text.encode()
+        self._database.scan(encoded, match_event_handler=on_match)
+        if found and not text.isascii():
+            # Report character offsets, like the other matchers: one pass over the
+            # bytes counts the characters started (non-continuation bytes) up to each one
+            char_ends = list(accumulate((byte & 0xC0) != 0x80 for byte in encoded))
+            found = [(char_ends[end] - 1, value) for end, value in found]
+        return iter(found)
+
+def build_keyword_automaton(patterns: Dict[str, tuple]) -> "ahocorasick.Automaton":
+    """
+    Build a multi-pattern matcher over lowercased patterns.
+    Its iter(text) yields (end index, value) for every occurrence of every pattern,
+    overlapping ones included, where value is the tuple given for the pattern.
+    """
+    if hyperscan is not None:
+        return _HyperscanMatcher(patterns)
+    if ahocorasick is None:
+        return _RegexMatcher(patterns)
+    return _build_ahocorasick(patterns)
+
+def _build_ahocorasick(patterns: Dict[str, tuple]) -> "ahocorasick.Automaton":
+    """Build a pyahocorasick automaton over the patterns"""
+    automaton = ahocorasick.Automaton()
+    for pattern, value in patterns.items():
+        automaton.add_word(pattern, value)
+    automaton.make_automaton()
+    return automaton
+
+def _build_automaton() -> "ahocorasick.Automaton":
+    """Build one automaton matching every keyword and context word, each tagged by its table"""
+    patterns: Dict[str, Set[_Match]] = {}
+    for tag, keyword, contexts in zip(_ALL_TAGS, _ALL_KEYWORDS, _ALL_CONTEXTS):
+        patterns.setdefault(keyword, set()).add((tag, keyword))
+        for context in contexts:
+            patterns.setdefault(context, set()).add((_CONTEXT_TAG, context))
     
-    # Check ESI Level 2 keywords (high risk)
-    for keyword, contexts in ESI_LEVEL_2_KEYWORDS.items():
-        if keyword.lower() in text:
-            # If keyword has no specific context requirements
-            if not contexts:
-                detected_keywords.append(f"ESI2:{keyword}")
-            # If keyword has context requirements, check if any context is present
-            elif any(context.lower() in text for context in contexts):
-                detected_keywords.append(f"ESI2:{keyword}")
+    # A word may belong to several tables, so each pattern carries all its tags
+    return build_keyword_automaton({pattern: tuple(matches) for pattern, matches in patterns.items()})
+
+# Finds every keyword and context word of every table in a single pass over the text
+_AUTOMATON = _build_automaton()
+
+DETECTION_CACHE_SIZE = 4096
+_detection_caches = []
+
+def _normalize(text: str) -> str:
+    """Lowercase the text and collapse whitespace, so equivalent messages share cache entries"""
+    return " ".join(text.lower().split())
+
+def _memoized(func):
+    """Cache a public detector's result on its input text, normalized once per call"""
+    cached = lru_cache(maxsize=DETECTION_CACHE_SIZE)(func)
+    _detection_caches.append(cached)
     
-    return detected_keywords
+    @wraps(func)
+    def wrapper(text: str):
+        return cached(_normalize(text))
+    return wrapper
 
+def clear_detection_caches() -> None:
+    """Clear the memoized detection results (e.g. between tests)"""
+    for cached in _detection_caches:
+        cached.cache_clear()
+
+# Internal helpers take already-normalized text and are not cached themselves:
+# only the public detectors below are memoized
+def _scan(text: str) -> FrozenSet[_Match]:
+    """Return every (tag, word) match in the text"""
+    found = set()
+    for _, matches in _AUTOMATON.iter(text):
+        found.update(matches)
+    return frozenset(found)
+
+def _scan_all(text: str) -> Tuple[_Match, ...]:
+    """Return (tag, label) for every detected keyword of every table, in table order"""
+    found = _scan(text)
+    hits = []
+    for i in sorted(_ENTRY_INDEX[match] for match in found if match in _ENTRY_INDEX):
+        # Keywords without context requirements match on their own; otherwise
+        # any one of the context words must also be present
+        contexts = _ALL_CONTEXTS[i]
+        if not contexts or any((_CONTEXT_TAG, context) in found for context in contexts):
+            hits.append((_ALL_TAGS[i], _ALL_LABELS[i]))
+    return tuple(hits)
+
+def _any_match(text: str, tag: str) -> bool:
+    """Return whether any keyword with the given tag matches, stopping at the first one found"""
+    seen_contexts = set()
+    pending_contexts = set()  # Context words that would complete a keyword already seen
+    for _, matches in _AUTOMATON.iter(text):
+        for match_tag, word in matches:
+            if match_tag == _CONTEXT_TAG:
+                if word in pending_contexts:
+                    return True
+                seen_contexts.add(word)
+            elif match_tag == tag:
+                contexts = _ALL_CONTEXTS[_ENTRY_INDEX[match_tag, word]]
+                if not contexts or not seen_contexts.isdisjoint(contexts):
+                    return True
+                pending_contexts.update(contexts)
+    return False
+
+def _labels(text: str, *tags: str) -> Tuple[str, ...]:
+    """Return the labels of the detected keywords with the given tags"""
+    return tuple(label for tag, label in _scan_all(text) if tag in tags)
+
+@_memoized
+def detect_critical_keywords(text: str) -> Tuple[str, ...]:
+    """
+    Detect critical keywords in the given text.
+    Returns a tuple of detected critical keywords.
+    """
+    # ESI Level 1 keywords come first, as their table precedes ESI Level 2's
+    return _labels(text, "ESI1", "ESI2")
+
+@_memoized
 def is_critical_condition(text: str) -> bool:
     """
     Determine if the text contains any ESI Level 1 keywords.
     Returns True if ESI Level 1 critical keywords are found, False otherwise.
     """
-    return any(keyword.startswith("ESI1:") for keyword in detect_critical_keywords(text))
+    return _any_match(text, "ESI1")
 
+@_memoized
 def is_high_risk_condition(text: str) -> bool:
     """
     Determine if the text contains any ESI Level 2 keywords.
     Returns True if ESI Level 2 high-risk keywords are found, False otherwise.
     """
-    return any(keyword.startswith("ESI2:") for keyword in detect_critical_keywords(text))
+    return _any_match(text, "ESI2")
 
-def detect_resource_keywords(text: str) -> List[str]:
+@_memoized
+def detect_resource_keywords(text: str) -> Tuple[str, ...]:
     """
     Detect keywords related to resource needs.
-    Returns a list of detected resource keywords.
+    Returns a tuple of detected resource keywords.
     """
-    text = text.lower()
-    detected_keywords = []
-    
-    for keyword, contexts in RESOURCE_KEYWORDS.items():
-        if keyword.lower() in text:
-            if not contexts:
-                detected_keywords.append(keyword)
-            elif any(context.lower() in text for context in contexts):
-                detected_keywords.append(keyword)
-    
-    return detected_keywords
+    return _labels(text, "RES")
 
+@_memoized
 def count_expected_resources(text: str) -> int:
     """
     Count the number of unique resources likely needed based on keywords.
     Returns an integer count of resources.
     """
-    # Get unique resource types from detected keywords
-    resource_keywords = detect_resource_keywords(text)
-    
-    # Map to resource categories
-    resource_categories = set()
-    
-    for keyword in resource_keywords:
-        if any(lab_term in keyword for lab_term in ["blood", "urine", "lab", "test", "culture"]):
-            resource_categories.add("lab")
-        elif any(imaging_term in keyword for imaging_term in ["x-ray", "ultrasound", "ct", "mri"]):
-            resource_categories.add("imaging")
-        elif any(iv_term in keyword for iv_term in ["iv", "intravenous"]):
-            resource_categories.add("iv")
-        elif any(procedure_term in keyword for procedure_term in ["stitches", "sutures", "wound", "splint", "cast", "drainage", "intubation", "catheter"]):
-            resource_categories.add("procedure")
-        elif any(specialist_term in keyword for specialist_term in ["specialist", "cardiology", "neurology", "orthopedics", "surgery", "obgyn", "pediatric"]):
-            resource_categories.add("specialist")
-    
-    return len(resource_categories)
+    # Each detected keyword counts once per resource category
+    return len({_KEYWORD_TO_CATEGORY[keyword] for keyword in _labels(text, "RES") if keyword in _KEYWORD_TO_CATEGORY})
 
-def detect_vital_sign_concerns(text: str) -> List[str]:
+@_memoized
+def detect_vital_sign_concerns(text: str) -> Tuple[str, ...]:
     """
     Detect keywords related to concerning vital signs.
-    Returns a list of detected vital sign concerns.
+    Returns a tuple of detected vital sign concerns.
     """
-    text = text.lower()
-    detected_concerns = []
-    
-    for keyword, contexts in VITAL_SIGN_KEYWORDS.items():
-        if keyword.lower() in text:
-            if not contexts:
-                detected_concerns.append(keyword)
-            elif any(context.lower() in text for context in contexts):
-                detected_concerns.append(keyword)
-    
-    return detected_concerns
+    return _labels(text, "VIT")
 
+@_memoized
 def has_pediatric_concerns(text: str) -> bool:
     """
     Determine if the text contains pediatric-specific concerns.
     Returns True if pediatric concern keywords are found, False otherwise.
     """
-    text = text.lower()
-    
-    for keyword, contexts in PEDIATRIC_KEYWORDS.items():
-        if keyword.lower() in text:
-            if not contexts:
-                return True
-            elif any(context.lower() in text for context in contexts):
-                return True
-    
-    return False 
\ No newline at end of file
+    return any(tag == "PED" for tag, _ in _scan_all(text)) 
\ No newline at end of file
@@ -1,8 +1,15 @@
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, Field, PrivateAttr, field_validator
+from typing import Deque, List, Optional, Tuple
+from collections import deque
+from dataclasses import dataclass, field
+from itertools import islice
 from datetime import datetime
+import time
 from enum import Enum
 
+# Maximum number of turns kept in a conversation history
+MAX_HISTORY_LENGTH = 20
+
 class ChannelType(str, Enum):
     PHONE = "phone"
     CHAT = "chat"
@@ -12,16 +19,16 @@ class PatientInfo(BaseModel):
     user_id: str
     age: Optional[int] = None
     sex: Optional[str] = None
-    previous_conditions: Optional[List[str]] = []
-    allergies: Optional[List[str]] = []
-    medications: Optional[List[str]] = []
-    contact_info: Optional[dict] = {}
+    previous_conditions: Optional[List[str]] = Field(default_factory=list)
+    allergies: Optional[List[str]] = Field(default_factory=list)
+    medications: Optional[List[str]] = Field(default_factory=list)
+    contact_info: Optional[dict] = Field(default_factory=dict)
 
 class ChannelInput(BaseModel):
     channel_type: ChannelType
     message: str
     user_id: str
-    timestamp: datetime = datetime.now()
+    timestamp: datetime = Field(default_factory=datetime.now)
     patient_info: Optional[PatientInfo] = None
 
 class AgentResponse(BaseModel):
@@ -30,8 +37,11 @@ class AgentResponse(BaseModel):
     confidence_score: float
     suggested_actions: List[str]
     esi_level: Optional[int] = None
-    expected_resources: Optional[List[str]] = []
-    vital_signs_concerns: Optional[List[str]] = []
+    expected_resources: Optional[List[str]] = Field(default_factory=list)
+    vital_signs_concerns: Optional[List[str]] = Field(default_factory=list)
+
+    # Keyword scan of `response` recorded by the triage engine, so later stages don't rescan it
+    _keyword_hits: Optional[int] = PrivateAttr(default=None)
 
 class ESILevel(int, Enum):
     """
@@ -64,27 +74,66 @@ class ResourceType(str, Enum):
     PROCEDURE = "procedure"
     NONE = "none"
 
-class TriageResult(BaseModel):
+# TriageResult and QueueItem are only built internally from already-validated values,
+# so they are slotted dataclasses rather than Pydantic models
+@dataclass(slots=True)
+class TriageResult:
     urgency_level: UrgencyLevel
     esi_level: ESILevel
     recommended_action: str
     reasoning: str
     requires_human_attention: bool
-    expected_resources: List[ResourceType] = []
-    vital_signs_concerns: List[str] = []
+    expected_resources: List[ResourceType] = field(default_factory=list)
+    vital_signs_concerns: List[str] = field(default_factory=list)
+
+class InquiryTriage(BaseModel):
+    urgency_level: str
+    recommended_action: str
+    requires_human_attention: bool
+    critical_keywords_detected: List[str] = Field(default_factory=list)
+
+class InquiryReply(BaseModel):
+    """Response body returned by the /inquiries endpoint"""
+    response: str
+    triage_result: InquiryTriage
+    suggested_actions: List[str]
 
 class ConversationContext(BaseModel):
     user_id: str
-    conversation_history: List[dict]
-    last_updated: datetime = datetime.now()
-    metadata: dict = {}
+    conversation_history: Deque[dict]
+    last_updated: float = Field(default_factory=time.time)  # Seconds since the epoch
+    metadata: dict = Field(default_factory=dict)
     patient_info: Optional[PatientInfo] = None
 
-class QueueItem(BaseModel):
+    @field_validator("conversation_history")
+    @classmethod
+    def _bound_history(cls, history: Deque[dict]) -> Deque[dict]:
+        # Bounded ring buffer: appends are O(1) and old turns drop off automatically
+        return deque(history, maxlen=MAX_HISTORY_LENGTH)
+
+    # Cached (patient_info, dumped dict) pair, reused while patient_info is unchanged
+    _patient_info_dump: Tuple[Optional[PatientInfo], Optional[dict]] = PrivateAttr(default=(None, None))
+
+    def recent_history(self, count: int) -> List[dict]:
+        """Return the last `count` turns of the conversation, oldest first"""
+        return list(islice(reversed(self.conversation_history), count))[::-1]
+
+    def patient_info_dict(self) -> Optional[dict]:
+        """Return patient_info as a JSON-ready dict, dumping it again only after it is replaced"""
+        if self.patient_info is None:
+            return None
+        cached_info, cached_dict = self._patient_info_dump
+        if cached_info is not self.patient_info:
+            cached_dict = self.patient_info.model_dump(mode="json", exclude_none=True)
+            self._patient_info_dump = (self.patient_info, cached_dict)
+        return cached_dict
+
+@dataclass(slots=True)
+class QueueItem:
     user_id: str
     urgency_level: UrgencyLevel
     esi_level: ESILevel
-    timestamp: datetime = datetime.now()
     channel_type: ChannelType
     context_summary: str
+    timestamp: float = field(default_factory=time.monotonic)  # time.monotonic() when queued
     patient_info: Optional[PatientInfo] = None 
\ No newline at end of file
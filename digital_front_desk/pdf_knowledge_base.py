@@ -1,14 +1,40 @@
 import os
 import re
+import multiprocessing
 import numpy as np
 import faiss
-from PyPDF2 import PdfReader
+import pypdfium2 as pdfium
+from concurrent.futures import ProcessPoolExecutor
 import openai
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from .telemetry import telemetry
 from opentelemetry import trace
 import time
 import asyncio
+from cachetools import LRUCache
+
+# Uppercase-only lines are treated as section headings
+_HEADING_RE = re.compile(r"^[A-Z][A-Z\s]+$")
+
+# Below this many pages, starting worker processes costs more than it saves
+PARALLEL_EXTRACTION_MIN_PAGES = 16
+
+def _extract_page_texts(page_range: Tuple[str, int, int]) -> List[str]:
+    """Extract the text of pages [start, stop) of a PDF; runs in a worker process"""
+    # pdfium handles can't be pickled, so each worker opens the file itself
+    pdf_path, start, stop = page_range
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        texts = []
+        for i in range(start, stop):
+            page = pdf[i]
+            textpage = page.get_textpage()
+            texts.append(textpage.get_text_range())
+            textpage.close()
+            page.close()
+        return texts
+    finally:
+        pdf.close()
 
 class PDFKnowledgeBase:
     def __init__(self):
@@ -17,9 +43,17 @@ class PDFKnowledgeBase:
         self.chunks = []
         self.loaded = False
         self.pdf_path = os.getenv("ESI_GUIDELINES_PATH", "esi_guidelines.pdf")
-        self.model_name = "text-embedding-ada-002"  # OpenAI embeddings model
+        self.model_name = "text-embedding-3-small"  # OpenAI embeddings model
         self.api_key = os.getenv("OPENAI_API_KEY")
-        self.embedding_dimension = 1536  # Dimension for text-embedding-ada-002
+        self.embedding_dimension = 1536  # Dimension for text-embedding-3-small
+        self.hnsw_neighbors = 32  # Graph degree (M) for the HNSW index
+        self.hnsw_ef_construction = 200  # Candidate list size while building the graph
+        self.hnsw_ef_search = 64  # Candidate list size per query (recall vs. latency)
+        self.embedding_concurrency = 8  # Embedding batches in flight at once
+        
+        # Common symptoms recur constantly, so reuse query embeddings and contexts
+        self._query_embeddings: LRUCache = LRUCache(maxsize=2048)
+        self._symptom_contexts: LRUCache = LRUCache(maxsize=1024)
         
     async def initialize(self) -> bool:
         """Initialize the knowledge base by loading the PDF and creating the embeddings index"""
@@ -29,19 +63,20 @@ class PDFKnowledgeBase:
             try:
                 # Check for OpenAI API key
                 if not self.api_key:
-                    span.set_attributes({
-                        "pdf.initialization_success": False,
-                        "pdf.error": "OpenAI API key not found"
-                    })
+                    if span.is_recording():
+                        span.set_attributes({
+                            "pdf.initialization_success": False,
+                            "pdf.error": "OpenAI API key not found"
+                        })
                     return False
                     
-                # Configure OpenAI client
-                self.client = openai.OpenAI(api_key=self.api_key)
+                # Configure OpenAI client; rate-limited requests are retried with backoff
+                self.client = openai.AsyncOpenAI(api_key=self.api_key, max_retries=5)
                 
                 # Process PDF if it exists
                 if os.path.exists(self.pdf_path):
-                    # Extract and process the text from the PDF
-                    data = self.extract_text_with_headings(self.pdf_path)
+                    # Extract and process the text from the PDF off the event loop
+                    data = await asyncio.to_thread(self.extract_text_with_headings, self.pdf_path)
                     self.chunks = self.chunk_by_headings(data)
                     
                     # Generate embeddings
@@ -55,51 +90,70 @@ class PDFKnowledgeBase:
                     processing_time = (time.time() - start_time) * 1000
                     telemetry.record_response_time(processing_time, "pdf_knowledge_base_init")
                     
-                    span.set_attributes({
-                        "pdf.chunks_count": len(self.chunks),
-                        "pdf.model_name": self.model_name,
-                        "pdf.processing_time_ms": processing_time,
-                        "pdf.initialization_success": True
-                    })
+                    if span.is_recording():
+                        span.set_attributes({
+                            "pdf.chunks_count": len(self.chunks),
+                            "pdf.model_name": self.model_name,
+                            "pdf.processing_time_ms": processing_time,
+                            "pdf.initialization_success": True
+                        })
                     
                     return True
                 else:
-                    span.set_attributes({
-                        "pdf.initialization_success": False,
-                        "pdf.error": "PDF file not found"
-                    })
+                    if span.is_recording():
+                        span.set_attributes({
+                            "pdf.initialization_success": False,
+                            "pdf.error": "PDF file not found"
+                        })
                     
                     return False
                     
             except Exception as e:
                 self.loaded = False
-                span.set_attributes({
-                    "pdf.initialization_success": False,
-                    "pdf.error": str(e)
-                })
+                if span.is_recording():
+                    span.set_attributes({
+                        "pdf.initialization_success": False,
+                        "pdf.error": str(e)
+                    })
                 return False
     
+    def extract_page_texts(self, pdf_path: str) -> List[str]:
+        """Extract the text of every page, splitting large PDFs across worker processes"""
+        pdf = pdfium.PdfDocument(pdf_path)
+        page_count = len(pdf)
+        pdf.close()
+        
+        # A single worker would only add the cost of spawning and re-importing
+        workers = min(os.cpu_count() or 1, page_count)
+        if page_count < PARALLEL_EXTRACTION_MIN_PAGES or workers <= 1:
+            return _extract_page_texts((pdf_path, 0, page_count))
+        
+        # One contiguous page range per worker, so each opens the document once
+        step = -(-page_count // workers)
+        page_ranges = [(pdf_path, start, min(start + step, page_count)) for start in range(0, page_count, step)]
+        # Spawned workers don't inherit the parent's threads or event loop state
+        with ProcessPoolExecutor(max_workers=len(page_ranges), mp_context=multiprocessing.get_context("spawn")) as executor:
+            return [text for texts in executor.map(_extract_page_texts, page_ranges) for text in texts]
+    
     def extract_text_from_pdf(self, pdf_path: str) -> str:
         """Extract all text from a PDF file"""
-        reader = PdfReader(pdf_path)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() + "\n"
-        return text
+        return "".join(text + "\n" for text in self.extract_page_texts(pdf_path))
     
     def extract_text_with_headings(self, pdf_path: str) -> List[Dict[str, str]]:
         """Extract text from PDF, organizing by headings"""
-        reader = PdfReader(pdf_path)
-        data = []
-        for page in reader.pages:
-            text = page.extract_text()
-            lines = text.split("\n")
-            for line in lines:
-                if re.match(r"^[A-Z][A-Z\s]+$", line.strip()):  # Detect uppercase headings
-                    data.append({"heading": line.strip(), "content": ""})
-                elif data:
-                    data[-1]["content"] += line.strip() + " "
-        return data
+        sections = []
+        for text in self.extract_page_texts(pdf_path):
+            for line in text.splitlines():
+                stripped = line.strip()
+                if not stripped:
+                    continue
+                if _HEADING_RE.match(stripped):  # Detect uppercase headings
+                    sections.append((stripped, []))
+                elif sections:
+                    sections[-1][1].append(stripped)
+        
+        # Join each section's lines once rather than growing a string per line
+        return [{"heading": heading, "content": " ".join(parts)} for heading, parts in sections]
     
     def chunk_by_headings(self, data: List[Dict[str, str]], max_chunk_size: int = 500) -> List[str]:
         """Break content into smaller chunks based on headings"""
@@ -114,44 +168,55 @@ class PDFKnowledgeBase:
     
     async def generate_embeddings(self, chunks: List[str]) -> np.ndarray:
         """Generate embeddings for text chunks using OpenAI API"""
-        all_embeddings = []
+        # Batches are sent concurrently, bounded so a large PDF doesn't burst the rate limit
+        batch_size = 256
+        semaphore = asyncio.Semaphore(self.embedding_concurrency)
         
-        # Process chunks in batches to avoid rate limiting
-        batch_size = 20
-        for i in range(0, len(chunks), batch_size):
-            batch_chunks = chunks[i:i + batch_size]
-            
+        # Each batch writes its rows straight into one preallocated matrix
+        embeddings = np.empty((len(chunks), self.embedding_dimension), dtype=np.float32)
+        await asyncio.gather(*[
+            self._embed_batch(semaphore, chunks[i:i + batch_size], embeddings[i:i + batch_size], i)
+            for i in range(0, len(chunks), batch_size)
+        ])
+        
+        return embeddings
+    
+    async def _embed_batch(
+        self,
+        semaphore: asyncio.Semaphore,
+        batch_chunks: List[str],
+        out: np.ndarray,
+        offset: int
+    ) -> None:
+        """Embed one batch of chunks into `out`, writing zero embeddings if the request fails"""
+        async with semaphore:
             try:
-                # Call OpenAI embeddings API with new client syntax
-                response = await asyncio.to_thread(
-                    lambda: self.client.embeddings.create(
-                        input=batch_chunks,
-                        model=self.model_name
-                    )
+                # Call OpenAI embeddings API (the client retries 429s with backoff)
+                response = await self.client.embeddings.create(
+                    input=batch_chunks,
+                    model=self.model_name
                 )
                 
                 # Extract embeddings from response
-                batch_embeddings = [item.embedding for item in response.data]
-                all_embeddings.extend(batch_embeddings)
-                
-                # Add a small delay to avoid rate limiting
-                if i + batch_size < len(chunks):
-                    await asyncio.sleep(0.5)
+                out[:] = [item.embedding for item in response.data]
                     
             except Exception as e:
-                # Log the error and continue with the next batch
-                print(f"Error generating embeddings for batch {i}: {str(e)}")
-                # Add zero embeddings for failed chunks to maintain alignment
-                zero_embeddings = [np.zeros(self.embedding_dimension) for _ in range(len(batch_chunks))]
-                all_embeddings.extend(zero_embeddings)
-                
-        return np.array(all_embeddings, dtype=np.float32)
+                # Log the error and continue with the other batches
+                print(f"Error generating embeddings for batch {offset}: {str(e)}")
+                # Zero embeddings for failed chunks to maintain alignment
+                out.fill(0)
     
-    def store_in_faiss(self, embeddings: np.ndarray) -> faiss.IndexFlatIP:
-        """Store embeddings in a FAISS index"""
+    def store_in_faiss(self, embeddings: np.ndarray) -> faiss.IndexHNSWSQ:
+        """Store embeddings in a FAISS HNSW index for sub-linear queries"""
         dimension = embeddings.shape[1]
-        index = faiss.IndexFlatIP(dimension)  # Inner product similarity
-        index.add(np.array(embeddings))
+        # Inner product over L2-normalized vectors == cosine similarity
+        faiss.normalize_L2(embeddings)
+        # Vectors are stored as FP16, halving the memory read per distance computation
+        index = faiss.IndexHNSWSQ(dimension, faiss.ScalarQuantizer.QT_fp16, self.hnsw_neighbors, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = self.hnsw_ef_construction
+        index.train(embeddings)
+        index.add(embeddings)
+        index.hnsw.efSearch = self.hnsw_ef_search
         return index
     
     async def query_knowledge_base(self, query: str, top_k: int = 3) -> List[str]:
@@ -163,46 +228,61 @@ class PDFKnowledgeBase:
                 return ["Knowledge base not initialized."]
             
             try:
-                # Generate embedding for the query using OpenAI API with new client syntax
-                response = await asyncio.to_thread(
-                    lambda: self.client.embeddings.create(
-                        input=[query],
-                        model=self.model_name
-                    )
-                )
-                
-                query_embedding = np.array([response.data[0].embedding], dtype=np.float32)
+                query_embedding = await self._embed_query(query)
                 
                 # Search the index
                 distances, indices = self.index.search(query_embedding, top_k)
                 
-                # Get the relevant chunks
-                relevant_chunks = [self.chunks[i] for i in indices[0]]
+                # Get the relevant chunks (HNSW pads with -1 when fewer results are found)
+                relevant_chunks = [self.chunks[i] for i in indices[0] if i >= 0]
                 
                 # Record metrics
                 processing_time = (time.time() - start_time) * 1000
                 telemetry.record_response_time(processing_time, "query_knowledge_base")
                 
-                span.set_attributes({
-                    "query.processing_time_ms": processing_time,
-                    "query.top_k": top_k,
-                    "query.success": True
-                })
+                if span.is_recording():
+                    span.set_attributes({
+                        "query.processing_time_ms": processing_time,
+                        "query.top_k": top_k,
+                        "query.success": True
+                    })
                 
                 return relevant_chunks
                 
             except Exception as e:
-                span.set_attributes({
-                    "query.success": False,
-                    "query.error": str(e)
-                })
+                if span.is_recording():
+                    span.set_attributes({
+                        "query.success": False,
+                        "query.error": str(e)
+                    })
                 return []
     
+    async def _embed_query(self, query: str) -> np.ndarray:
+        """Embed a query as a normalized (1, d) array, reusing cached embeddings"""
+        query_embedding = self._query_embeddings.get(query)
+        if query_embedding is None:
+            # Generate embedding for the query using OpenAI API
+            response = await self.client.embeddings.create(
+                input=[query],
+                model=self.model_name
+            )
+            
+            query_embedding = np.array([response.data[0].embedding], dtype=np.float32)
+            faiss.normalize_L2(query_embedding)
+            self._query_embeddings[query] = query_embedding
+        return query_embedding
+    
     async def get_context_for_symptoms(self, symptoms: str) -> str:
         """Get relevant ESI guidelines context based on patient symptoms"""
         if not self.loaded:
             return ""
             
+        # Identical symptoms up to case and spacing share one lookup
+        symptoms = " ".join(symptoms.lower().split())
+        context = self._symptom_contexts.get(symptoms)
+        if context is not None:
+            return context
+            
         # Create a more focused query based on the symptoms
         query = f"ESI triage guidelines for patient with {symptoms}"
         
@@ -212,6 +292,10 @@ class PDFKnowledgeBase:
         # Combine the chunks into a single context string
         context = "\n\n".join(relevant_chunks)
         
+        # Failed queries return no chunks and are not cached
+        if context:
+            self._symptom_contexts[symptoms] = context
+        
         return context
 
 # Create global instance
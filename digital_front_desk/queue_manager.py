@@ -1,127 +1,141 @@
 from .models import QueueItem, UrgencyLevel
 from .telemetry import telemetry
-from typing import Optional, List
+from opentelemetry.metrics import CallbackOptions, Observation
+from typing import Callable, Dict, Iterable, Optional, List, Tuple
 import heapq
 import time
-from datetime import datetime, timedelta
+from collections import deque
 
-class PriorityQueue:
-    def __init__(self):
-        self._queue = []
-        self._entry_count = 0
-        self._removed_entries = set()
-
-    def add(self, item: QueueItem):
-        # Priority is negative urgency level (so higher urgency = lower number = higher priority)
-        # Secondary sort by timestamp
-        priority = (-item.urgency_level.value, item.timestamp.timestamp())
-        entry = [priority, self._entry_count, item]
-        self._entry_count += 1
-        heapq.heappush(self._queue, entry)
-
-    def remove(self, user_id: str):
-        self._removed_entries.add(user_id)
-
-    def pop(self) -> Optional[QueueItem]:
-        while self._queue:
-            priority, count, item = heapq.heappop(self._queue)
-            if item.user_id not in self._removed_entries:
-                return item
-        return None
-
-    def peek(self) -> Optional[QueueItem]:
-        while self._queue:
-            priority, count, item = self._queue[0]
-            if item.user_id not in self._removed_entries:
-                return item
-            heapq.heappop(self._queue)
-        return None
+WAIT_TIME_WINDOW = 1024  # Number of recent wait times averaged in the queue status
+COMPACT_MIN_HEAP = 64  # Heaps smaller than this are never compacted
 
 class QueueManager:
+    """
+    Single heap of queue items across all urgency levels, with lazy deletion
+    (the heapq cancellation recipe). Entries are ordered by urgency, then by
+    the time they were queued. Only the latest entry pushed for each user is
+    live; removed or superseded entries stay in the heap as stale tuples and
+    are discarded when they surface, or all at once when they outnumber the
+    live entries, so users re-queueing repeatedly can't grow the heap unboundedly.
+    """
+
     def __init__(self):
-        self.queues = {
-            UrgencyLevel.CRITICAL: PriorityQueue(),
-            UrgencyLevel.HIGH: PriorityQueue(),
-            UrgencyLevel.MEDIUM: PriorityQueue(),
-            UrgencyLevel.LOW: PriorityQueue()
-        }
+        self._heap: List[Tuple[int, float, int, QueueItem]] = []
+        self._entry_count = 0
+        self._active: Dict[str, Tuple[int, UrgencyLevel]] = {}  # user_id -> (entry id, level) of the live entry
         
         # Metrics
         self.queue_sizes = {level: 0 for level in UrgencyLevel}
-        self.wait_times = []
+        self.wait_times = deque(maxlen=WAIT_TIME_WINDOW)  # Most recent wait times
+        self._wait_sum = 0.0  # Rolling sum of self.wait_times
+
+        # Queue sizes are read by the exporter when it collects, so queue
+        # operations don't record them; the wait-time histogram is created once
+        self._queue_gauges = [
+            telemetry.meter.create_observable_gauge(
+                name=f"queue.size.{level.name.lower()}",
+                callbacks=[self._observe_size(level)],
+                description=f"Number of items in {level.name} queue",
+                unit="1"
+            )
+            for level in UrgencyLevel
+        ]
+        self._wait_hist = telemetry.meter.create_histogram(
+            name="queue.wait_time",
+            description="Wait time for items in queue",
+            unit="s"
+        )
 
     def add_to_queue(self, item: QueueItem):
         with telemetry.tracer.start_as_current_span("queue_add_item") as span:
-            span.set_attributes({
-                "queue.urgency_level": item.urgency_level.value,
-                "queue.user_id": item.user_id
-            })
+            if span.is_recording():
+                span.set_attributes({
+                    "queue.urgency_level": item.urgency_level.value,
+                    "queue.user_id": item.user_id
+                })
             
-            self.queues[item.urgency_level].add(item)
-            self.queue_sizes[item.urgency_level] += 1
+            # Re-adding a queued user replaces their entry rather than adding one
+            replaced = self._active.get(item.user_id)
+            if replaced is not None:
+                self.queue_sizes[replaced[1]] -= 1
             
-            # Record metrics
-            self._record_queue_metrics()
+            # Higher urgency = lower number = higher priority; ties go to the earliest queued
+            entry_id = self._entry_count
+            self._entry_count += 1
+            self._active[item.user_id] = (entry_id, item.urgency_level)
+            heapq.heappush(self._heap, (-item.urgency_level.value, item.timestamp, entry_id, item))
+            self.queue_sizes[item.urgency_level] += 1
+            if replaced is not None:
+                self._compact()
 
     def get_next_item(self) -> Optional[QueueItem]:
         with telemetry.tracer.start_as_current_span("queue_get_next") as span:
-            # Try to get items in order of urgency
-            for level in UrgencyLevel:
-                item = self.queues[level].pop()
-                if item:
+            # Pop until a live entry surfaces; the heap yields the most urgent first
+            while self._heap:
+                _, _, entry_id, item = heapq.heappop(self._heap)
+                live = self._active.get(item.user_id)
+                if live is not None and live[0] == entry_id:
+                    del self._active[item.user_id]
+                    level = live[1]
                     self.queue_sizes[level] -= 1
                     
                     # Calculate and record wait time
-                    wait_time = (datetime.now() - item.timestamp).total_seconds()
-                    self.wait_times.append(wait_time)
+                    wait_time = time.monotonic() - item.timestamp
+                    self._record_wait_time(wait_time)
                     
-                    span.set_attributes({
-                        "queue.item_found": True,
-                        "queue.urgency_level": level.value,
-                        "queue.wait_time": wait_time
-                    })
+                    if span.is_recording():
+                        span.set_attributes({
+                            "queue.item_found": True,
+                            "queue.urgency_level": level.value,
+                            "queue.wait_time": wait_time
+                        })
                     
                     # Record metrics
-                    self._record_queue_metrics()
+                    self._wait_hist.record(wait_time)
                     return item
             
-            span.set_attributes({"queue.item_found": False})
+            if span.is_recording():
+                span.set_attributes({"queue.item_found": False})
             return None
 
     def remove_from_queue(self, user_id: str):
         with telemetry.tracer.start_as_current_span("queue_remove_item") as span:
-            span.set_attributes({"queue.user_id": user_id})
-            
-            # Remove from all queues (user should only be in one, but being thorough)
-            for queue in self.queues.values():
-                queue.remove(user_id)
+            if span.is_recording():
+                span.set_attributes({"queue.user_id": user_id})
             
-            # Record metrics
-            self._record_queue_metrics()
+            # The stale heap entry is discarded when it surfaces
+            removed = self._active.pop(user_id, None)
+            if removed is not None:
+                self.queue_sizes[removed[1]] -= 1
+                self._compact()
 
     def get_queue_status(self) -> dict:
         return {
             "queue_sizes": self.queue_sizes,
-            "average_wait_time": sum(self.wait_times) / len(self.wait_times) if self.wait_times else 0,
+            "average_wait_time": self._wait_sum / len(self.wait_times) if self.wait_times else 0,
             "total_items": sum(self.queue_sizes.values())
         }
 
-    def _record_queue_metrics(self):
-        # Record queue sizes
-        for level, size in self.queue_sizes.items():
-            telemetry.meter.create_counter(
-                name=f"queue.size.{level.name.lower()}",
-                description=f"Number of items in {level.name} queue",
-                unit="1"
-            ).add(size)
-        
-        # Record average wait time
-        if self.wait_times:
-            telemetry.meter.create_histogram(
-                name="queue.wait_time",
-                description="Wait time for items in queue",
-                unit="s"
-            ).record(sum(self.wait_times) / len(self.wait_times))
+    def _compact(self):
+        """Drop the stale entries once they make up more than half of the heap"""
+        if len(self._heap) < COMPACT_MIN_HEAP or len(self._active) * 2 >= len(self._heap):
+            return
+        live_ids = {entry_id for entry_id, _ in self._active.values()}
+        self._heap = [entry for entry in self._heap if entry[2] in live_ids]
+        heapq.heapify(self._heap)
+
+    def _record_wait_time(self, wait_time: float):
+        # Keep the rolling sum in step with the window as old wait times drop out
+        if len(self.wait_times) == self.wait_times.maxlen:
+            self._wait_sum -= self.wait_times[0]
+        self.wait_times.append(wait_time)
+        self._wait_sum += wait_time
+
+    def _observe_size(self, level: UrgencyLevel) -> Callable[[CallbackOptions], Iterable[Observation]]:
+        """Build the gauge callback reporting the current size of a queue"""
+        def callback(options: CallbackOptions) -> Iterable[Observation]:
+            return [Observation(self.queue_sizes[level])]
+        return callback
 
 # Global instance
 queue_manager = QueueManager() 
\ No newline at end of file
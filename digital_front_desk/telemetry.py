@@ -1,23 +1,106 @@
+import os
+import threading
 from opentelemetry import trace, metrics
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.metrics import MeterProvider
-from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
-from opentelemetry.exporter.zipkin.json import ZipkinExporter
-from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
-from opentelemetry.sdk.resources import Resource
 from typing import Optional
 
+# Set OTEL_ENABLED=1 to export spans to Zipkin and metrics over OTLP.
+# Otherwise no-op tracer and meter are used and no exporters are opened.
+OTEL_ENABLED = os.getenv("OTEL_ENABLED") == "1"
+
+class _NoopSpan:
+    """
+    Span stand-in used while telemetry is disabled. It is its own context
+    manager, so entering it touches neither the OTel context nor the allocator.
+    """
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        return False
+
+    def is_recording(self) -> bool:
+        return False
+
+    def set_attribute(self, key, value) -> None:
+        pass
+
+    def set_attributes(self, attributes) -> None:
+        pass
+
+    def set_status(self, status, description=None) -> None:
+        pass
+
+    def add_event(self, name, attributes=None, timestamp=None) -> None:
+        pass
+
+    def record_exception(self, exception, attributes=None, timestamp=None, escaped=False) -> None:
+        pass
+
+    def end(self, end_time=None) -> None:
+        pass
+
+_NOOP_SPAN = _NoopSpan()
+
+class _NoopTracer:
+    """Tracer used while telemetry is disabled; every span is the shared _NOOP_SPAN"""
+
+    def start_as_current_span(self, name, *args, **kwargs) -> _NoopSpan:
+        return _NOOP_SPAN
+
+    def start_span(self, name, *args, **kwargs) -> _NoopSpan:
+        return _NOOP_SPAN
+
 class TelemetryManager:
     _instance: Optional['TelemetryManager'] = None
+    _lock = threading.Lock()
     
     def __new__(cls):
         if cls._instance is None:
-            cls._instance = super(TelemetryManager, cls).__new__(cls)
-            cls._instance._initialize()
+            with cls._lock:
+                if cls._instance is None:
+                    instance = super(TelemetryManager, cls).__new__(cls)
+                    instance._initialize()
+                    cls._instance = instance
         return cls._instance
 
     def _initialize(self):
+        self.enabled = OTEL_ENABLED
+        if self.enabled:
+            self._initialize_exporters()
+        else:
+            self.tracer = _NoopTracer()
+            self.meter = metrics.NoOpMeter(__name__)
+
+        # Create metrics
+        self.request_counter = self.meter.create_counter(
+            name="front_desk.requests",
+            description="Number of requests processed",
+            unit="1"
+        )
+
+        self.response_time = self.meter.create_histogram(
+            name="front_desk.response_time",
+            description="Response time for processing requests",
+            unit="ms"
+        )
+
+        self.triage_scores = self.meter.create_histogram(
+            name="front_desk.triage_scores",
+            description="Distribution of triage scores",
+            unit="1"
+        )
+
+    def _initialize_exporters(self):
+        # The SDK and exporters are only imported when telemetry is enabled
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.sdk.metrics import MeterProvider
+        from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+        from opentelemetry.exporter.zipkin.json import ZipkinExporter
+        from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
+        from opentelemetry.sdk.resources import Resource
+
         # Create resource
         resource = Resource.create({
             "service.name": "digital-front-desk",
@@ -41,25 +124,6 @@ class TelemetryManager:
         metrics.set_meter_provider(metric_provider)
         self.meter = metrics.get_meter(__name__)
 
-        # Create metrics
-        self.request_counter = self.meter.create_counter(
-            name="front_desk.requests",
-            description="Number of requests processed",
-            unit="1"
-        )
-
-        self.response_time = self.meter.create_histogram(
-            name="front_desk.response_time",
-            description="Response time for processing requests",
-            unit="ms"
-        )
-
-        self.triage_scores = self.meter.create_histogram(
-            name="front_desk.triage_scores",
-            description="Distribution of triage scores",
-            unit="1"
-        )
-
     def record_request(self, channel_type: str):
         self.request_counter.add(1, {"channel": channel_type})
 
@@ -0,0 +1,4 @@
+import os
+
+# Modules build OpenAI clients at import time; no request is sent in tests
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
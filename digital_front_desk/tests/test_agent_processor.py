@@ -0,0 +1,28 @@
+import asyncio
+
+from digital_front_desk.agent_processor import AgentProcessor, CHARS_PER_TOKEN
+
+
+def test_turn_tokens_leave_stored_turns_unchanged():
+    processor = AgentProcessor()
+    turn = {"role": "user", "content": "I have had a headache since this morning"}
+
+    tokens = processor._turn_tokens(turn)
+
+    assert tokens > 0
+    assert set(turn) == {"role", "content"}
+    assert processor._turn_tokens(dict(turn)) == tokens
+
+
+def test_turn_tokens_estimate_without_encoding():
+    processor = AgentProcessor()
+    processor._encoding = None
+    content = "x" * (CHARS_PER_TOKEN * 10)
+
+    assert processor._turn_tokens({"role": "user", "content": content}) == 11
+
+
+def test_closing_the_client_closes_the_pooled_connections():
+    processor = AgentProcessor()
+    asyncio.run(processor.client.close())
+    assert processor.http_client.is_closed
@@ -0,0 +1,102 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from digital_front_desk import api
+from digital_front_desk.api import LazyHashedUser
+
+
+class SlowContext:
+    """Stands in for the bcrypt context with a slow, counted hash"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def hash(self, password):
+        self.calls += 1
+        time.sleep(0.01)
+        return "hashed:" + password
+
+
+def test_concurrent_first_logins_hash_once(monkeypatch):
+    context = SlowContext()
+    monkeypatch.setattr(api, "pwd_context", context)
+    user = LazyHashedUser({"username": "demo", "password": "secret"})
+    barrier = threading.Barrier(8)
+
+    def read_hash(_):
+        barrier.wait()
+        return user["hashed_password"]
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(read_hash, range(8)))
+
+    assert results == ["hashed:secret"] * 8
+    assert context.calls == 1
+    assert "password" not in user
+
+
+def test_missing_password_raises_key_error():
+    with pytest.raises(KeyError):
+        LazyHashedUser({"username": "demo"})["hashed_password"]
+
+
+def test_concurrent_registrations_claim_a_username_once(monkeypatch):
+    def slow_hash(password):
+        time.sleep(0.01)
+        return "hashed:" + password
+    monkeypatch.setattr(api, "get_password_hash", slow_hash)
+    form = SimpleNamespace(username="dup", password="secret")
+
+    async def run():
+        return await asyncio.gather(api.register_user(form), api.register_user(form), return_exceptions=True)
+
+    try:
+        results = asyncio.run(run())
+        assert sum(isinstance(result, HTTPException) for result in results) == 1
+        assert [user["username"] for user in api.fake_users_db.values()].count("dup") == 1
+    finally:
+        user = api.fake_users_by_username.pop("dup", None)
+        if user is not None:
+            api.fake_users_db.pop(user["user_id"], None)
+
+
+def test_decoded_tokens_are_reused(monkeypatch):
+    api._token_cache.clear()
+    token = api.create_access_token({"sub": "test-user-2"})
+    decodes = []
+    real_decode = api.jwt.decode
+    monkeypatch.setattr(api.jwt, "decode", lambda *args, **kwargs: decodes.append(1) or real_decode(*args, **kwargs))
+
+    assert api._decode_token(token)["sub"] == "test-user-2"
+    assert api._decode_token(token)["sub"] == "test-user-2"
+    assert len(decodes) == 1
+
+
+def test_expired_cached_claims_are_decoded_again():
+    api._token_cache.clear()
+    token = api.create_access_token({"sub": "test-user-2"})
+    payload = api._decode_token(token)
+    api._token_cache[token] = (payload, 0)
+
+    assert api._decode_token(token)["sub"] == "test-user-2"
+    assert api._token_cache[token][1] == payload["exp"]
+
+
+def test_expired_tokens_are_rejected():
+    api._token_cache.clear()
+    token = api.create_access_token({"sub": "test-user-2"}, expires_delta=api.timedelta(seconds=-1))
+    with pytest.raises(api.jwt.ExpiredSignatureError):
+        api._decode_token(token)
+
+
+def test_tokens_without_required_claims_are_rejected():
+    api._token_cache.clear()
+    token = api.jwt.encode({"sub": "test-user-2"}, api.SECRET_KEY, algorithm=api.ALGORITHM)
+    with pytest.raises(api.jwt.MissingRequiredClaimError):
+        api._decode_token(token)
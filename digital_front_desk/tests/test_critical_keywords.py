@@ -0,0 +1,73 @@
+import pytest
+
+from digital_front_desk import critical_keywords
+from digital_front_desk.critical_keywords import (
+    clear_detection_caches,
+    count_expected_resources,
+    detect_critical_keywords,
+    detect_resource_keywords,
+)
+
+
+def test_detectors_share_entries_for_equivalent_text():
+    clear_detection_caches()
+    assert detect_critical_keywords("I have CHEST   pain") == ("ESI2:chest pain",)
+    assert detect_critical_keywords("i have chest pain") == ("ESI2:chest pain",)
+    assert sum(cached.cache_info().hits for cached in critical_keywords._detection_caches) == 1
+
+
+def test_only_public_detectors_are_cached():
+    assert len(critical_keywords._detection_caches) == 7
+    assert not hasattr(critical_keywords._scan, "cache_info")
+    assert not hasattr(critical_keywords._scan_all, "cache_info")
+
+
+def test_resource_count_is_per_category():
+    text = "I need an x-ray and a blood test"
+    assert detect_resource_keywords(text) == ("blood test", "x-ray")
+    assert count_expected_resources(text) == 2
+
+
+
+# Values are tuples of (tag, word) matches, as _build_automaton builds them
+PATTERNS = {
+    "chest pain": (("ESI2", "chest pain"),),
+    "chest": (("CTX", "chest"),),
+    "pain": (("CTX", "pain"),),
+    "ain": (("CTX", "ain"),),
+    "café": (("CTX", "café"),),
+}
+
+BACKENDS = {"regex": critical_keywords._RegexMatcher}
+if critical_keywords.ahocorasick is not None:
+    BACKENDS["ahocorasick"] = critical_keywords._build_ahocorasick
+if critical_keywords.hyperscan is not None:
+    BACKENDS["hyperscan"] = critical_keywords._HyperscanMatcher
+
+CASES = [
+    # ASCII, with overlapping patterns ending at the same and at different offsets
+    ("chest pain now", [(4, "chest"), (9, "ain"), (9, "chest pain"), (9, "pain")]),
+    # Non-ASCII text before and inside matches: offsets are in characters
+    ("ça fait mal, chest pain", [(17, "chest"), (22, "ain"), (22, "chest pain"), (22, "pain")]),
+    ("au café 🙂 pain", [(6, "café"), (13, "ain"), (13, "pain")]),
+    ("nothing here", []),
+]
+
+
+def _found(matcher, text):
+    return sorted((end, word) for end, matches in matcher.iter(text) for _, word in matches)
+
+
+@pytest.mark.parametrize("backend", sorted(set(BACKENDS) - {"regex"}))
+@pytest.mark.parametrize("text, expected", CASES)
+def test_automaton_backends_report_character_offsets(backend, text, expected):
+    assert _found(BACKENDS[backend](PATTERNS), text) == expected
+
+
+@pytest.mark.parametrize("backend", sorted(BACKENDS))
+@pytest.mark.parametrize("text, expected", CASES)
+def test_backends_find_the_same_matches(backend, text, expected):
+    # The regex fallback reports prefixes at the end of the longest pattern
+    # starting at the same position, so only the matches themselves compare
+    found = [word for _, word in _found(BACKENDS[backend](PATTERNS), text)]
+    assert sorted(found) == sorted(word for _, word in expected)
@@ -0,0 +1,55 @@
+from digital_front_desk.models import ChannelType, ESILevel, QueueItem, UrgencyLevel
+from digital_front_desk.queue_manager import COMPACT_MIN_HEAP, QueueManager
+
+
+def make_item(user_id, level, timestamp):
+    return QueueItem(
+        user_id=user_id,
+        urgency_level=level,
+        esi_level=ESILevel.LEVEL_3,
+        channel_type=ChannelType.CHAT,
+        context_summary="",
+        timestamp=timestamp
+    )
+
+
+def drain(queue):
+    users = []
+    while (item := queue.get_next_item()) is not None:
+        users.append(item.user_id)
+    return users
+
+
+def test_most_urgent_first_then_earliest_queued():
+    queue = QueueManager()
+    queue.add_to_queue(make_item("low", UrgencyLevel.LOW, 1.0))
+    queue.add_to_queue(make_item("high-late", UrgencyLevel.HIGH, 3.0))
+    queue.add_to_queue(make_item("critical", UrgencyLevel.CRITICAL, 4.0))
+    queue.add_to_queue(make_item("high-early", UrgencyLevel.HIGH, 2.0))
+    queue.add_to_queue(make_item("medium", UrgencyLevel.MEDIUM, 0.5))
+
+    assert drain(queue) == ["critical", "high-early", "high-late", "medium", "low"]
+
+
+def test_requeue_replaces_and_remove_drops_entries():
+    queue = QueueManager()
+    queue.add_to_queue(make_item("a", UrgencyLevel.LOW, 1.0))
+    queue.add_to_queue(make_item("b", UrgencyLevel.MEDIUM, 2.0))
+    queue.add_to_queue(make_item("a", UrgencyLevel.CRITICAL, 3.0))
+    queue.add_to_queue(make_item("c", UrgencyLevel.HIGH, 4.0))
+    queue.remove_from_queue("c")
+
+    assert queue.get_queue_status()["total_items"] == 2
+    assert queue.queue_sizes[UrgencyLevel.LOW] == 0
+    assert drain(queue) == ["a", "b"]
+    assert queue.get_queue_status()["total_items"] == 0
+
+
+def test_repeated_requeues_keep_the_heap_bounded():
+    queue = QueueManager()
+    queue.add_to_queue(make_item("other", UrgencyLevel.LOW, 0.0))
+    for i in range(COMPACT_MIN_HEAP * 10):
+        queue.add_to_queue(make_item("user", UrgencyLevel.MEDIUM, float(i)))
+
+    assert len(queue._heap) < COMPACT_MIN_HEAP
+    assert drain(queue) == ["user", "other"]
@@ -0,0 +1,63 @@
+import pytest
+
+from digital_front_desk.models import AgentResponse, ESILevel, ResourceType, UrgencyLevel
+from digital_front_desk.triage import TriageEngine
+
+
+def make_response(text, score=0.0):
+    return AgentResponse(response=text, triage_score=score, confidence_score=0.9, suggested_actions=[])
+
+
+@pytest.fixture
+def engine():
+    return TriageEngine()
+
+
+def test_scan_sets_one_bit_per_phrase(engine):
+    hits = engine._scan("severe chest pain and dizziness")
+    found = {phrase for phrase in engine._phrases if hits & engine._phrase_bits[phrase]}
+    assert found == {"chest pain", "dizziness"}
+
+
+def test_resources_are_merged_as_a_bitmask(engine):
+    # chest pain and dizziness both predict a lab test, which counts once
+    bits, resource_count = engine._predict_resource_needs(engine._scan("chest pain and dizziness"))
+    assert resource_count == 3
+    result = engine.process(make_response("chest pain and dizziness"))
+    assert result.expected_resources == [ResourceType.LAB_TEST, ResourceType.IMAGING, ResourceType.MEDICATION]
+
+
+@pytest.mark.parametrize("text, score, level", [
+    ("the patient is unconscious", 0.0, ESILevel.LEVEL_1),
+    ("no keywords at all", 0.95, ESILevel.LEVEL_1),
+    ("I have chest pain", 0.0, ESILevel.LEVEL_2),
+    ("abdominal pain since lunch", 0.0, ESILevel.LEVEL_3),
+    ("a small sprain", 0.0, ESILevel.LEVEL_4),
+    ("just a question about opening hours", 0.0, ESILevel.LEVEL_5),
+])
+def test_esi_levels(engine, text, score, level):
+    assert engine.process(make_response(text, score)).esi_level == level
+
+
+def test_process_records_the_scan_on_the_response(engine):
+    response = make_response("Chest pain")
+    engine.process(response)
+    assert response._keyword_hits == engine._phrase_bits["chest pain"]
+
+
+def test_batch_matches_individual_processing(engine):
+    texts = [
+        "cardiac arrest",
+        "chest pain",
+        "",
+        "fracture of the wrist",
+        "minor pain",
+        "infant fever and dehydration in child",
+        # No phrase may match across the boundary between two texts
+        "it started in my chest",
+        "pain",
+    ]
+    batch = engine.process_batch([make_response(text, 0.5) for text in texts])
+    single = [engine.process(make_response(text, 0.5)) for text in texts]
+    assert batch == single
+    assert batch[0].urgency_level == UrgencyLevel.CRITICAL
@@ -1,49 +1,94 @@
 from .models import AgentResponse, TriageResult, UrgencyLevel, ESILevel, ResourceType
 from .telemetry import telemetry
-from .critical_keywords import detect_critical_keywords, is_critical_condition
+from .critical_keywords import detect_critical_keywords, is_critical_condition, build_keyword_automaton
 import time
-from typing import List, Dict, Set, Tuple
+from bisect import bisect_right
+from itertools import count
+from typing import List, Dict, FrozenSet, Tuple
+
+# Phrases found in a response, as a bitmask over TriageEngine._phrases
+_TriageHits = int
+
+# Resource types as a bitmask: one bit per ResourceType, in declaration order
+_RESOURCE_TYPES: Tuple[ResourceType, ...] = tuple(ResourceType)
+_RESOURCE_BITS: Dict[ResourceType, int] = {resource: 1 << i for i, resource in enumerate(_RESOURCE_TYPES)}
+
+def _resources_from_bits(bits: int) -> List[ResourceType]:
+    """Expand a resource bitmask into the list of its resource types"""
+    return [resource for resource in _RESOURCE_TYPES if bits & _RESOURCE_BITS[resource]]
+
+# Joins response texts for a batch scan; it occurs in no phrase, so no match spans two texts
+_BATCH_SEPARATOR = "\x01"
+
+# Only 1 in this many ESI Level 4/5 triages records its processing time
+LOW_ACUITY_SAMPLE_EVERY = 10
+
+# Recommended action for each ESI level, indexed by ESI value - 1
+_ACTIONS: Tuple[str, ...] = (
+    "Immediate life-saving intervention required - transfer to emergency response",
+    "High-risk situation - priority routing to available healthcare provider",
+    "Multiple resources needed - schedule urgent consultation",
+    "One resource needed - schedule non-urgent appointment",
+    "No resources needed - provide self-care instructions and resources",
+)
+
+# Reasoning summary for each ESI level, indexed by ESI value - 1
+_REASONING_PREFIX: Tuple[str, ...] = (
+    "Patient requires immediate life-saving intervention. ",
+    "High-risk situation or severe pain/distress identified. ",
+    "Multiple resources needed ({resource_count}). ",
+    "One resource needed. ",
+    "No resources needed. ",
+)
 
 class TriageEngine:
+    __slots__ = (
+        "life_threatening_conditions", "high_risk_conditions",
+        "multiple_resource_indicators", "single_resource_indicators",
+        "vital_sign_concerns", "pediatric_concerns", "resource_predictions",
+        "_phrases", "_phrase_bits", "_category_masks", "_automaton",
+        "_resource_bits", "_esi_to_urgency", "_human_levels", "_low_acuity_calls",
+    )
+
     def __init__(self):
         # Life-threatening conditions (ESI Level 1)
-        self.life_threatening_conditions = {
+        self.life_threatening_conditions = (
             'cardiac arrest', 'respiratory arrest', 'intubation', 'severe respiratory distress',
             'anaphylaxis', 'severe shock', 'unconscious', 'not breathing', 
             'stroke symptoms acute', 'severe trauma', 'severe bleeding'
-        }
+        )
         
         # High-risk conditions (ESI Level 2)
-        self.high_risk_conditions = {
+        self.high_risk_conditions = (
             'chest pain', 'difficulty breathing', 'altered mental status', 'severe pain',
             'stroke symptoms', 'acute vision change', 'suicidal', 'homicidal', 
             'severe headache', 'high fever', 'overdose', 'acute confusion'
-        }
+        )
         
         # Conditions likely requiring multiple resources (ESI Level 3)
-        self.multiple_resource_indicators = {
+        self.multiple_resource_indicators = (
             'abdominal pain', 'moderate pain', 'fracture', 'dehydration', 'dizziness',
             'persistent vomiting', 'infection', 'wound requiring sutures'
-        }
+        )
         
         # Conditions likely requiring one resource (ESI Level 4)
-        self.single_resource_indicators = {
+        self.single_resource_indicators = (
             'simple laceration', 'sprain', 'minor infection', 'medication refill',
             'minor pain', 'rash without systemic symptoms'
-        }
+        )
         
         # Common vital sign abnormalities requiring attention
-        self.vital_sign_concerns = {
+        self.vital_sign_concerns = (
             'high heart rate', 'low heart rate', 'high blood pressure', 'low blood pressure',
             'high respiratory rate', 'low respiratory rate', 'high fever', 'low temperature',
             'low oxygen saturation'
-        }
+        )
         
         # Pediatric-specific concerns
-        self.pediatric_concerns = {
+        self.pediatric_concerns = (
             'infant fever', 'child respiratory distress', 'child lethargy',
             'dehydration in child', 'failure to thrive'
-        }
+        )
         
         # Map of predicted resources by condition
         self.resource_predictions: Dict[str, List[ResourceType]] = {
@@ -58,68 +103,116 @@ class TriageEngine:
             'dizziness': [ResourceType.LAB_TEST],
             'rash': [ResourceType.MEDICATION],
         }
+        
+        keyword_categories: Dict[str, Tuple[str, ...]] = {
+            'L1': self.life_threatening_conditions,
+            'L2': self.high_risk_conditions,
+            'multi': self.multiple_resource_indicators,
+            'single': self.single_resource_indicators,
+            'vital': self.vital_sign_concerns,
+            'peds': self.pediatric_concerns,
+            'res': tuple(self.resource_predictions),
+        }
+        
+        # Every distinct phrase gets one bit; a category is the mask of its phrases' bits
+        self._phrases: Tuple[str, ...] = tuple(dict.fromkeys(
+            phrase for phrases in keyword_categories.values() for phrase in phrases
+        ))
+        self._phrase_bits: Dict[str, int] = {phrase: 1 << i for i, phrase in enumerate(self._phrases)}
+        self._category_masks: Dict[str, int] = {
+            category: sum(self._phrase_bits[phrase] for phrase in phrases)
+            for category, phrases in keyword_categories.items()
+        }
+        
+        # One automaton finds the phrases of every category in a single pass over the text
+        self._automaton = build_keyword_automaton(
+            {phrase: (bit,) for phrase, bit in self._phrase_bits.items()}
+        )
+        
+        # Resources predicted by each condition, as a bitmask
+        self._resource_bits: Dict[str, int] = {
+            condition: sum(_RESOURCE_BITS[resource] for resource in set(resource_list))
+            for condition, resource_list in self.resource_predictions.items()
+        }
+        
+        # Legacy urgency for each ESI level, indexed by ESI value - 1
+        self._esi_to_urgency: Tuple[UrgencyLevel, ...] = (
+            UrgencyLevel.CRITICAL,  # ESI Level 1
+            UrgencyLevel.HIGH,      # ESI Level 2
+            UrgencyLevel.MEDIUM,    # ESI Level 3
+            UrgencyLevel.LOW,       # ESI Level 4
+            UrgencyLevel.LOW,       # ESI Level 5
+        )
+        
+        # ESI levels that need a human to follow up
+        self._human_levels: FrozenSet[ESILevel] = frozenset({ESILevel.LEVEL_1, ESILevel.LEVEL_2, ESILevel.LEVEL_3})
+        
+        # Counts low-acuity triages for response time sampling
+        self._low_acuity_calls = count()
+
+    def _scan(self, text: str) -> _TriageHits:
+        """Find every keyword phrase in the lowercased text, as a bitmask of phrases"""
+        hits = 0
+        for _, bits in self._automaton.iter(text):
+            for bit in bits:
+                hits |= bit
+        return hits
 
-    def _detect_esi_level_1_conditions(self, text: str) -> bool:
+    def _detect_esi_level_1_conditions(self, hits: _TriageHits) -> bool:
         """
         Detect conditions requiring immediate life-saving interventions (ESI Level 1)
         """
-        text = text.lower()
-        return any(condition in text for condition in self.life_threatening_conditions)
+        return bool(hits & self._category_masks['L1'])
 
-    def _detect_esi_level_2_conditions(self, text: str) -> bool:
+    def _detect_esi_level_2_conditions(self, hits: _TriageHits) -> bool:
         """
         Detect high-risk conditions or severe pain/distress (ESI Level 2)
         """
-        text = text.lower()
-        return any(condition in text for condition in self.high_risk_conditions)
+        return bool(hits & self._category_masks['L2'])
 
-    def _predict_resource_needs(self, text: str) -> Tuple[List[ResourceType], int]:
+    def _predict_resource_needs(self, hits: _TriageHits) -> Tuple[int, int]:
         """
         Predict the number of resources needed based on the patient's condition.
-        Returns a tuple of (resources, count) where resources is a list of predicted
-        ResourceType objects and count is the total number of unique resources.
+        Returns a tuple of (resources, count) where resources is a bitmask of predicted
+        resource types (see _RESOURCE_BITS) and count is the number of unique resources.
         """
-        text = text.lower()
-        resources: Set[ResourceType] = set()
+        resources = 0
         
         # Check for specific conditions and add their associated resources
-        for condition, resource_list in self.resource_predictions.items():
-            if condition in text:
-                resources.update(resource_list)
+        for condition, condition_resources in self._resource_bits.items():
+            if hits & self._phrase_bits[condition]:
+                resources |= condition_resources
         
         # Check for general resource indicators
-        if any(indicator in text for indicator in self.multiple_resource_indicators):
+        if hits & self._category_masks['multi']:
             # Ensure at least 2 resources for level 3
-            if len(resources) < 2:
+            if resources.bit_count() < 2:
                 # Add generic resources to reach 2+
-                if ResourceType.LAB_TEST not in resources:
-                    resources.add(ResourceType.LAB_TEST)
-                if ResourceType.IMAGING not in resources and len(resources) < 2:
-                    resources.add(ResourceType.IMAGING)
+                resources |= _RESOURCE_BITS[ResourceType.LAB_TEST]
+                if resources.bit_count() < 2:
+                    resources |= _RESOURCE_BITS[ResourceType.IMAGING]
         
-        if len(resources) == 0 and any(indicator in text for indicator in self.single_resource_indicators):
+        if resources == 0 and hits & self._category_masks['single']:
             # Add a single generic resource for level 4
-            resources.add(ResourceType.MEDICATION)
+            resources = _RESOURCE_BITS[ResourceType.MEDICATION]
         
-        return list(resources), len(resources)
+        return resources, resources.bit_count()
 
-    def _detect_vital_sign_concerns(self, text: str) -> List[str]:
+    def _detect_vital_sign_concerns(self, hits: _TriageHits) -> List[str]:
         """
         Detect mentions of concerning vital signs that might indicate higher acuity
         """
-        text = text.lower()
-        return [concern for concern in self.vital_sign_concerns if concern in text]
+        return [concern for concern in self.vital_sign_concerns if hits & self._phrase_bits[concern]]
 
-    def _check_pediatric_considerations(self, text: str) -> bool:
+    def _check_pediatric_considerations(self, hits: _TriageHits) -> bool:
         """
         Check for pediatric-specific concerns that might require up-triaging
         """
-        text = text.lower()
-        return any(concern in text for concern in self.pediatric_concerns)
+        return bool(hits & self._category_masks['peds'])
 
     def _determine_esi_level(self, 
                              agent_triage_score: float, 
-                             text: str, 
+                             hits: _TriageHits, 
                              resource_count: int) -> ESILevel:
         """
         Determine ESI level based on:
@@ -130,20 +223,20 @@ class TriageEngine:
         5. Pediatric considerations
         """
         # Check for life-threatening conditions (ESI Level 1)
-        if self._detect_esi_level_1_conditions(text) or agent_triage_score > 0.9:
+        if agent_triage_score > 0.9 or self._detect_esi_level_1_conditions(hits):
             return ESILevel.LEVEL_1
         
         # Check for high-risk conditions (ESI Level 2)
-        if self._detect_esi_level_2_conditions(text) or agent_triage_score > 0.7:
+        if agent_triage_score > 0.7 or self._detect_esi_level_2_conditions(hits):
             return ESILevel.LEVEL_2
         
         # Check vital signs - may up-triage to Level 2 if concerning
-        vital_concerns = self._detect_vital_sign_concerns(text)
+        vital_concerns = self._detect_vital_sign_concerns(hits)
         if vital_concerns and (agent_triage_score > 0.5 or resource_count >= 2):
             return ESILevel.LEVEL_2
         
         # Check pediatric considerations - may up-triage
-        if self._check_pediatric_considerations(text) and agent_triage_score > 0.4:
+        if self._check_pediatric_considerations(hits) and agent_triage_score > 0.4:
             # Up-triage pediatric patients with concerning symptoms
             return ESILevel.LEVEL_2 if resource_count >= 1 else ESILevel.LEVEL_3
         
@@ -157,96 +250,136 @@ class TriageEngine:
 
     def _map_esi_to_urgency(self, esi_level: ESILevel) -> UrgencyLevel:
         """Maps ESI levels to legacy UrgencyLevel for backward compatibility"""
-        mapping = {
-            ESILevel.LEVEL_1: UrgencyLevel.CRITICAL,
-            ESILevel.LEVEL_2: UrgencyLevel.HIGH,
-            ESILevel.LEVEL_3: UrgencyLevel.MEDIUM,
-            ESILevel.LEVEL_4: UrgencyLevel.LOW,
-            ESILevel.LEVEL_5: UrgencyLevel.LOW
-        }
-        return mapping[esi_level]
+        return self._esi_to_urgency[esi_level.value - 1]
 
     def process(self, agent_response: AgentResponse) -> TriageResult:
         """Process the agent response to determine ESI triage level and requirements"""
         with telemetry.tracer.start_as_current_span("triage_process") as span:
-            start_time = time.time()
-            
-            text = agent_response.response.lower()
-            
-            # Predict required resources
-            expected_resources, resource_count = self._predict_resource_needs(text)
+            start_ns = time.perf_counter_ns()
             
-            # Detect vital sign concerns
-            vital_concerns = self._detect_vital_sign_concerns(text)
+            # Scan the response once; every check below reads these hits
+            hits = agent_response._keyword_hits
+            if hits is None:
+                hits = self._scan(agent_response.response.lower())
+                agent_response._keyword_hits = hits
             
-            # Determine ESI level
-            esi_level = self._determine_esi_level(
-                agent_response.triage_score,
-                text,
-                resource_count
-            )
+            result, resource_count = self._triage(agent_response.triage_score, hits)
+            esi_level = result.esi_level
             
-            # Map ESI level to legacy urgency level for backward compatibility
-            urgency_level = self._map_esi_to_urgency(esi_level)
+            # Record for telemetry; low-acuity triages are sampled
+            if telemetry.enabled and (
+                esi_level.value < ESILevel.LEVEL_4.value
+                or next(self._low_acuity_calls) % LOW_ACUITY_SAMPLE_EVERY == 0
+            ):
+                telemetry.record_response_time(
+                    (time.perf_counter_ns() - start_ns) / 1e6,  # Convert to milliseconds
+                    "triage_engine"
+                )
             
-            # Generate action mapping based on ESI level
-            action_map = {
-                ESILevel.LEVEL_1: "Immediate life-saving intervention required - transfer to emergency response",
-                ESILevel.LEVEL_2: "High-risk situation - priority routing to available healthcare provider",
-                ESILevel.LEVEL_3: "Multiple resources needed - schedule urgent consultation",
-                ESILevel.LEVEL_4: "One resource needed - schedule non-urgent appointment",
-                ESILevel.LEVEL_5: "No resources needed - provide self-care instructions and resources"
-            }
-            
-            # Determine if human attention is required
-            requires_human = esi_level in {ESILevel.LEVEL_1, ESILevel.LEVEL_2, ESILevel.LEVEL_3}
-            
-            # Create reasoning string
-            reasoning = f"ESI Level {esi_level.value}: "
+            # Add trace attributes
+            if span.is_recording():
+                span.set_attributes({
+                    "triage.esi_level": esi_level.value,
+                    "triage.urgency_level": result.urgency_level.value,
+                    "triage.resource_count": resource_count,
+                    "triage.requires_human": result.requires_human_attention,
+                })
             
-            if esi_level == ESILevel.LEVEL_1:
-                reasoning += "Patient requires immediate life-saving intervention. "
-            elif esi_level == ESILevel.LEVEL_2:
-                reasoning += "High-risk situation or severe pain/distress identified. "
-            elif esi_level == ESILevel.LEVEL_3:
-                reasoning += f"Multiple resources needed ({resource_count}). "
-            elif esi_level == ESILevel.LEVEL_4:
-                reasoning += "One resource needed. "
-            else:  # ESI Level 5
-                reasoning += "No resources needed. "
-                
-            if vital_concerns:
-                reasoning += f"Vital sign concerns: {', '.join(vital_concerns)}. "
+            return result
+
+    def process_batch(self, agent_responses: List[AgentResponse]) -> List[TriageResult]:
+        """Triage several agent responses, scanning all of their texts in one pass"""
+        with telemetry.tracer.start_as_current_span("triage_process_batch") as span:
+            start_ns = time.perf_counter_ns()
             
-            if expected_resources:
-                reasoning += f"Expected resources: {', '.join([r.value for r in expected_resources])}."
+            self._scan_batch([r for r in agent_responses if r._keyword_hits is None])
+            results = [
+                self._triage(agent_response.triage_score, agent_response._keyword_hits)[0]
+                for agent_response in agent_responses
+            ]
             
-            # Create triage result
-            result = TriageResult(
-                urgency_level=urgency_level,
-                esi_level=esi_level,
-                recommended_action=action_map[esi_level],
-                reasoning=reasoning,
-                requires_human_attention=requires_human,
-                expected_resources=expected_resources,
-                vital_signs_concerns=vital_concerns
-            )
+            if telemetry.enabled:
+                telemetry.record_response_time(
+                    (time.perf_counter_ns() - start_ns) / 1e6,  # Convert to milliseconds
+                    "triage_engine_batch"
+                )
             
-            # Record for telemetry
-            telemetry.record_response_time(
-                (time.time() - start_time) * 1000,  # Convert to milliseconds
-                "triage_engine"
-            )
+            if span.is_recording():
+                span.set_attributes({"triage.batch_size": len(agent_responses)})
             
-            # Add trace attributes
-            span.set_attributes({
-                "triage.esi_level": esi_level.value,
-                "triage.urgency_level": urgency_level.value,
-                "triage.resource_count": resource_count,
-                "triage.requires_human": requires_human,
-            })
+            return results
+
+    def _scan_batch(self, agent_responses: List[AgentResponse]):
+        """Scan the responses' texts in one pass and record each one's hits on it"""
+        if not agent_responses:
+            return
+        texts = [agent_response.response.lower() for agent_response in agent_responses]
+        
+        # Start offset of each text in the joined buffer
+        starts = []
+        position = 0
+        for text in texts:
+            starts.append(position)
+            position += len(text) + len(_BATCH_SEPARATOR)
+        
+        hits = [0] * len(texts)
+        for end, bits in self._automaton.iter(_BATCH_SEPARATOR.join(texts)):
+            i = bisect_right(starts, end) - 1
+            for bit in bits:
+                hits[i] |= bit
+        
+        for agent_response, response_hits in zip(agent_responses, hits):
+            agent_response._keyword_hits = response_hits
+
+    def _triage(self, agent_triage_score: float, hits: _TriageHits) -> Tuple[TriageResult, int]:
+        """Build the triage result for a scanned response; returns (result, resource count)"""
+        # Predict required resources
+        resource_bits, resource_count = self._predict_resource_needs(hits)
+        expected_resources = _resources_from_bits(resource_bits)
+        
+        # Detect vital sign concerns
+        vital_concerns = self._detect_vital_sign_concerns(hits)
+        
+        # Determine ESI level
+        esi_level = self._determine_esi_level(
+            agent_triage_score,
+            hits,
+            resource_count
+        )
+        
+        # Map ESI level to legacy urgency level for backward compatibility
+        urgency_level = self._map_esi_to_urgency(esi_level)
+        
+        # Determine if human attention is required
+        requires_human = esi_level in self._human_levels
+        
+        # Create reasoning string
+        level_index = esi_level.value - 1
+        parts = [
+            f"ESI Level {esi_level.value}: ",
+            _REASONING_PREFIX[level_index].format(resource_count=resource_count)
+        ]
             
-            return result
+        if vital_concerns:
+            parts.append(f"Vital sign concerns: {', '.join(vital_concerns)}. ")
+        
+        if expected_resources:
+            parts.append(f"Expected resources: {', '.join([r.value for r in expected_resources])}.")
+        
+        reasoning = "".join(parts)
+        
+        # Create triage result
+        result = TriageResult(
+            urgency_level=urgency_level,
+            esi_level=esi_level,
+            recommended_action=_ACTIONS[level_index],
+            reasoning=reasoning,
+            requires_human_attention=requires_human,
+            expected_resources=expected_resources,
+            vital_signs_concerns=vital_concerns
+        )
+        
+        return result, resource_count
 
 # Global instance
 triage_engine = TriageEngine() 
\ No newline at end of file